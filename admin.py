@@ -1,22 +1,54 @@
 # -*- coding: utf-8 -*-
-from django.contrib import admin
-from .models import Thread, Post, Vote, Media, Attachment
+from django.contrib import admin, messages
+from django.utils.translation import ugettext_lazy as _
+from .models import Thread, Post, Vote, Media, MediaDerivative, Attachment, NotificationSetting, PendingReply, moderate_posts
+from .pagination import EstimatedCountPaginator
 
 class ThreadAdmin(admin.ModelAdmin):
-    list_display = ('category', 'crdate', 'tstamp', 'is_closed', 'is_deleted')
+    list_display = ('category', 'crdate', 'tstamp', 'last_post_date', 'reply_count', 'is_closed', 'is_deleted')
     list_filter = ('is_closed', 'is_deleted', 'crdate', 'tstamp')
     #date_hierarchy = 'crdate'
 
 class PostAdmin(admin.ModelAdmin):
     raw_id_fields = ('thread', 'author')
     search_fields = ('author__username', 'author__email', '^author__first_name', '^author__last_name')
-    list_display = ('thread', 'author', 'get_cleaned_content', 'crdate', 'tstamp', 'edited',
+    list_display = ('id', 'thread', 'author', 'preview', 'crdate', 'tstamp', 'edited',
                     'is_deleted', 'is_approved', 'is_flagged', 'is_spam', 'is_highlighted')
-    list_filter = ('is_deleted', 'is_approved', 'is_flagged', 'is_spam', 'is_highlighted',
-                   'crdate', 'tstamp', 'edited')
-    #date_hierarchy = 'crdate'
-    list_select_related = True
+    list_filter = ('is_approved', 'is_flagged', 'is_highlighted', 'is_spam', 'is_deleted')
+    list_select_related = ('thread', 'author')
     list_per_page = 50
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('approve_posts', 'spam_posts', 'delete_posts', 'undelete_posts')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('content', 'content_cleaned', 'path')
+
+    def moderate_selected_posts(self, request, queryset, action, message, permission='comments.change_post'):
+        if not request.user.has_perm(permission):
+            self.message_user(request, _('You are not allowed to moderate posts this way.'), level=messages.ERROR)
+            return
+        post_ids = moderate_posts(queryset, action)
+        self.message_user(request, message % len(post_ids))
+
+    def approve_posts(self, request, queryset):
+        self.moderate_selected_posts(request, queryset, 'approve', _('%d posts have been approved.'))
+    approve_posts.short_description = _('Approve selected posts')
+
+    def spam_posts(self, request, queryset):
+        self.moderate_selected_posts(request, queryset, 'spam', _('%d posts have been marked as spam.'))
+    spam_posts.short_description = _('Mark selected posts as spam')
+
+    def delete_posts(self, request, queryset):
+        self.moderate_selected_posts(request, queryset, 'delete', _('%d posts have been marked as deleted.'),
+                                     'comments.delete_post')
+    delete_posts.short_description = _('Mark selected posts as deleted')
+
+    def undelete_posts(self, request, queryset):
+        self.moderate_selected_posts(request, queryset, 'undelete', _('%d posts have been marked as not-deleted.'),
+                                     'comments.delete_post')
+    undelete_posts.short_description = _('Mark selected posts as not-deleted')
 
 class VoteAdmin(admin.ModelAdmin):
     raw_id_fields = ('post', 'user')
@@ -27,12 +59,29 @@ class MediaAdmin(admin.ModelAdmin):
     raw_id_fields = ('post',)
     list_display = ('post', 'image', 'width', 'height')
 
+class MediaDerivativeAdmin(admin.ModelAdmin):
+    raw_id_fields = ('media',)
+    list_display = ('media', 'image', 'format', 'width', 'height')
+    list_filter = ('format', 'width')
+
 class AttachmentAdmin(admin.ModelAdmin):
     raw_id_fields = ('post',)
     list_display = ('post', 'file')
 
+class NotificationSettingAdmin(admin.ModelAdmin):
+    raw_id_fields = ('user',)
+    list_display = ('user', 'immediate_replies')
+    list_filter = ('immediate_replies',)
+
+class PendingReplyAdmin(admin.ModelAdmin):
+    raw_id_fields = ('user', 'post')
+    list_display = ('user', 'post', 'crdate')
+
 admin.site.register(Thread, ThreadAdmin)
 admin.site.register(Post, PostAdmin)
 admin.site.register(Vote, VoteAdmin)
 admin.site.register(Media, MediaAdmin)
+admin.site.register(MediaDerivative, MediaDerivativeAdmin)
 admin.site.register(Attachment, AttachmentAdmin)
+admin.site.register(NotificationSetting, NotificationSettingAdmin)
+admin.site.register(PendingReply, PendingReplyAdmin)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from collections import OrderedDict, namedtuple
+import threading, time
+
+AuthorCard = namedtuple('AuthorCard', ('id', 'username', 'name', 'avatar', 'version'))
+
+class LocalCache(object):
+    # Bounded LRU cache with a short timeout, since entries cannot be
+    # invalidated across processes
+    def __init__(self, max_size=1024, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                values[key] = entry[1]
+        return values
+
+    def set_many(self, values):
+        expires = time.monotonic() + self.timeout
+        with self.lock:
+            for key, value in values.items():
+                self.entries[key] = (expires, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+local_cache = LocalCache()
+
+def get_card_key(author_id):
+    return 'comments:author:%d' % author_id
+
+def get_author_cards(author_ids):
+    from .models import Author
+
+    author_ids = set(author_ids)
+    cards = local_cache.get_many(author_ids)
+
+    missing_ids = author_ids - set(cards)
+    if missing_ids:
+        cached_cards = cache.get_many([get_card_key(author_id) for author_id in missing_ids])
+        cached_cards = {card.id: card for card in cached_cards.values()}
+        local_cache.set_many(cached_cards)
+        cards.update(cached_cards)
+        missing_ids -= set(cached_cards)
+
+    if missing_ids:
+        version = int(time.time() * 1000000)
+        authors = Author.objects.filter(id__in=missing_ids).only('id', 'username', 'first_name', 'email')
+        loaded_cards = {author.id: AuthorCard(author.id, author.username, author.name, author.avatar, version)
+                        for author in authors}
+        cache.set_many({get_card_key(author_id): card for author_id, card in loaded_cards.items()}, 86400)
+        local_cache.set_many(loaded_cards)
+        cards.update(loaded_cards)
+
+    return cards
+
+def get_author_card(author_id):
+    return get_author_cards((author_id,)).get(author_id)
+
+def attach_author_cards(posts):
+    cards = get_author_cards(post.author_id for post in posts)
+    for post in posts:
+        post.author_card = cards.get(post.author_id)
+
+def delete_author_card(author_id):
+    local_cache.delete(author_id)
+    cache.delete(get_card_key(author_id))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+from ...models import Post
+from ... import sanitizer
+import threading, time
+
+SAMPLE_CONTENT = ('<p>Hello <b>there</b>, have a look at https://www.example.com/some/path?query=%d '
+                  'and <a href="http://example.org/">this link</a>.<br>'
+                  '<script>alert("nope")</script><em>Thanks</em> for www.example.net!</p>\n') * 20
+
+class Command(BaseCommand):
+    help = 'Measure the throughput of the post content sanitizer across threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', default='1,4,16',
+                            help='Comma-separated list of thread counts to measure')
+        parser.add_argument('--posts', type=int, default=1000,
+                            help='Number of posts to clean per measurement')
+        parser.add_argument('--from-db', action='store_true', default=False,
+                            help='Clean the content of existing posts instead of sample content')
+        parser.add_argument('--locked', action='store_true', default=False,
+                            help='Also measure a single shared cleaner guarded by a lock')
+
+    def handle(self, *args, **options):
+        if options['from_db']:
+            contents = list(Post.objects.values_list('content', flat=True)[:options['posts']])
+        else:
+            contents = [SAMPLE_CONTENT % index for index in range(options['posts'])]
+
+        locked_cleaner = sanitizer.get_cleaner()
+        locked_cleaner_sem = threading.Semaphore()
+
+        def clean_locked(content):
+            fixed_linebreaks = sanitizer.fix_linebreaks(content)
+            with locked_cleaner_sem:
+                return locked_cleaner.clean(fixed_linebreaks)
+
+        modes = [('pooled', sanitizer.clean_content)]
+        if options['locked']:
+            modes.append(('locked', clean_locked))
+
+        for threads in [int(value) for value in options['threads'].split(',')]:
+            for mode, clean in modes:
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    start = time.perf_counter()
+                    for cleaned in executor.map(clean, contents):
+                        pass
+                    duration = time.perf_counter() - start
+                self.stdout.write('%-6s %3d threads: %d posts in %.3fs, %.1f posts/s' % (
+                                  mode, threads, len(contents), duration, len(contents) / duration))
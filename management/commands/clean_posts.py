@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from django.db import connections
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from concurrent.futures import ProcessPoolExecutor
+from ...models import Post
+from ...tasks import get_uncleaned_posts, iter_post_id_chunks, clean_posts, clean_post_chunk
+
+class Command(BaseCommand):
+    help = 'Clean the content of posts in chunks, e.g. after an import or a sanitizer change'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Clean all posts instead of only the uncleaned ones')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of posts to clean and update at once')
+        parser.add_argument('--processes', type=int, default=0,
+                            help='Number of processes to clean the content with')
+        parser.add_argument('--async', action='store_true', default=False, dest='run_async',
+                            help='Dispatch the chunks as Celery tasks instead of cleaning them here')
+        parser.add_argument('--start-id', type=int, default=0,
+                            help='Only clean posts with an id greater than this one')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Continue after the last post cleaned by a previous run')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            posts = Post.objects.all()
+            marker_key = 'comments:clean_posts:all:last_id'
+        else:
+            posts = get_uncleaned_posts()
+            marker_key = 'comments:clean_posts:last_id'
+
+        start_id = options['start_id']
+        if options['resume']:
+            start_id = max(start_id, cache.get(marker_key, 0))
+
+        executor = None
+        if options['processes'] and not options['run_async']:
+            # The worker processes only clean content, they must not inherit open connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options['processes'])
+
+        count = 0
+        try:
+            for post_ids in iter_post_id_chunks(posts, options['chunk_size'], start_id):
+                if options['run_async']:
+                    clean_post_chunk.delay(post_ids)
+                elif executor:
+                    clean_posts(post_ids, map=executor.map)
+                else:
+                    clean_posts(post_ids)
+                count += len(post_ids)
+                cache.set(marker_key, post_ids[-1], None)
+                self.stdout.write('Processed %d posts up to id %d' % (count, post_ids[-1]))
+        finally:
+            if executor:
+                executor.shutdown()
+
+        cache.delete(marker_key)
+        self.stdout.write('Successfully processed %d posts' % count)
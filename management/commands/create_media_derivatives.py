@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from django.db import connections
+from django.core.management.base import BaseCommand
+from concurrent.futures import ProcessPoolExecutor
+from ...models import Media, delete_post_fragments, touch_version
+from ...tasks import create_media_derivatives, delete_files
+from ... import thumbnails
+
+class Command(BaseCommand):
+    help = 'Create the thumbnails of existing media, e.g. after changing the widths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Recreate the thumbnails of all media instead of only the missing ones')
+        parser.add_argument('--processes', type=int, default=0,
+                            help='Number of processes to resize the images with')
+        parser.add_argument('--async', action='store_true', default=False, dest='run_async',
+                            help='Dispatch the media as Celery tasks instead of resizing them here')
+        parser.add_argument('--start-id', type=int, default=0,
+                            help='Only process media with an id greater than this one')
+
+    def handle(self, *args, **options):
+        media_list = Media.objects.filter(id__gt=options['start_id']).order_by('id')
+        if not options['all']:
+            media_list = media_list.filter(derivatives=None)
+        media_list = media_list.select_related('post', 'post__thread')
+
+        executor = None
+        if options['processes'] and not options['run_async']:
+            # The worker processes only resize images, they must not inherit open connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options['processes'])
+
+        count = 0
+        try:
+            for media in media_list.iterator():
+                if options['run_async']:
+                    create_media_derivatives.delay(media.id)
+                else:
+                    try:
+                        old_names = thumbnails.create_derivatives(media, map=executor.map if executor else map)
+                    except (IOError, OSError) as e:
+                        self.stderr.write('Skipped media %d: %s' % (media.id, e))
+                        continue
+                    delete_files(media.image.storage, old_names)
+                    delete_post_fragments(media.post)
+                    touch_version(media.post.thread.category, media.post.thread_id)
+                count += 1
+                if count % 100 == 0:
+                    self.stdout.write('Processed %d media up to id %d' % (count, media.id))
+        finally:
+            if executor:
+                executor.shutdown()
+
+        self.stdout.write('Successfully processed %d media' % count)
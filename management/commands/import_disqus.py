@@ -1,163 +1,411 @@
 # -*- coding: utf-8 -*-
-from django.db import transaction
-from django.utils import timezone, text
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
 from django.core.files.base import ContentFile
 from django.core.management.base import BaseCommand, CommandError
 from social_django.models import UserSocialAuth
-from ...models import User, Author, Thread, Post, Vote, Media
-from disqusapi import DisqusAPI
-import os.path, isodate, urllib.request
+from ...models import User, Thread, Post, Vote, Media, ImportCheckpoint, ImportDeferredPost
+from ...models import get_path_segment, touch_version
+from ...tasks import clean_posts
+from concurrent.futures import ThreadPoolExecutor
+import os.path, isodate, urllib.request, urllib.parse, urllib.error
+import threading, socket, json, time
+
+BATCH_SIZE = 500
+DISQUS_API_URL = 'https://disqus.com/api/3.0/'
+
+def chunked(values, size=BATCH_SIZE):
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+def restore_crdates(model, objects, crdates):
+    # Inserting sets the creation dates to now, the imported ones are written
+    # afterwards with a few rows per statement
+    for chunk in chunked(zip(objects, crdates), 100):
+        crdate = Case(*[When(id=obj.id, then=Value(crdate)) for obj, crdate in chunk], output_field=DateTimeField())
+        model.objects.filter(id__in=[obj.id for obj, crdate in chunk]).update(crdate=crdate)
+        for obj, crdate in chunk:
+            obj.crdate = crdate
+
+class DisqusClient(object):
+    def __init__(self, secret_key, public_key, api_url=DISQUS_API_URL,
+                 timeout=30, retries=3, host_limit=4):
+        self.secret_key = secret_key
+        self.public_key = public_key
+        self.api_url = api_url
+        self.timeout = timeout
+        self.retries = retries
+        self.host_limit = host_limit
+        self.host_semaphores = {}
+        self.host_semaphores_lock = threading.Lock()
+
+    def get_host_semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.host_semaphores_lock:
+            if not host in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_limit)
+            return self.host_semaphores[host]
+
+    def fetch(self, url):
+        host_semaphore = self.get_host_semaphore(url)
+        for attempt in range(self.retries + 1):
+            try:
+                with host_semaphore:
+                    with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                        return response.read()
+            except urllib.error.HTTPError as e:
+                # Only server errors and rate limits are worth another try
+                if (e.code < 500 and e.code != 429) or attempt == self.retries:
+                    raise
+            except (urllib.error.URLError, socket.timeout, ConnectionError):
+                if attempt == self.retries:
+                    raise
+            # Back off without holding a slot, other requests to the host go on
+            time.sleep(2 ** attempt)
+
+    def request(self, endpoint, **params):
+        params.update(api_secret=self.secret_key, api_key=self.public_key)
+        url = '%s%s.json?%s' % (self.api_url, endpoint, urllib.parse.urlencode(params, doseq=True))
+        data = json.loads(self.fetch(url).decode('utf-8'))
+        if data.get('code', 0) != 0:
+            raise CommandError('Disqus API error %s: %s' % (data.get('code'), data.get('response')))
+        return data
+
+    def list_posts(self, forum, include, cursor=None):
+        params = {'forum': forum, 'include': include, 'order': 'asc', 'limit': 100}
+        if cursor:
+            params['cursor'] = cursor
+        return self.request('posts/list', **params)
+
+    def list_voters(self, thread, post, vote, limit):
+        data = self.request('posts/listUsersVotedPost', thread=thread, post=post, vote=vote, limit=limit)
+        return data['response']
 
 class Command(BaseCommand):
-    args = '<disqus-forum> <secret-key> <public-key>'
     help = 'Import Disqus comments and authors from JSON API'
 
-    def handle(self, *args, **options):
-        if len(args) < 3:
-            raise CommandError('Missing arguments: <disqus-forum> <secret-key> <public-key>')
+    def add_arguments(self, parser):
+        parser.add_argument('forum', metavar='disqus-forum')
+        parser.add_argument('secret_key', metavar='secret-key')
+        parser.add_argument('public_key', metavar='public-key')
+        parser.add_argument('--api-url', default=DISQUS_API_URL,
+                            help='Base URL of the Disqus API, e.g. a local stand-in for testing')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Number of concurrent requests for media and voters')
+        parser.add_argument('--host-limit', type=int, default=4,
+                            help='Number of concurrent requests per host')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Timeout of each request in seconds')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='Number of retries of failed requests')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Continue from the checkpoint of a previous run')
 
-        disqus_api = DisqusAPI(args[1], args[2])
-        disqus_forum = args[0]
+    def handle(self, *args, **options):
+        disqus_client = DisqusClient(options['secret_key'], options['public_key'], options['api_url'],
+                                     options['timeout'], options['retries'], options['host_limit'])
+        disqus_forum = options['forum']
         disqus_posts_include = ('unapproved', 'approved', 'spam', 'deleted', 'flagged', 'highlighted')
-        disqus_posts = disqus_api.posts.list(forum=disqus_forum,
-                                             include=disqus_posts_include,
-                                             order='asc')
 
-        disqus_posts_list = []
-        while len(disqus_posts):
-            disqus_posts_list += disqus_posts.response
+        checkpoint, created = ImportCheckpoint.objects.get_or_create(forum=disqus_forum)
+        cursor = None
+        if options['resume'] and checkpoint.cursor:
+            print('Resuming after post', checkpoint.last_post_id)
+            cursor = checkpoint.cursor
+
+        # Every page is imported and committed on its own, together with the
+        # cursor of the next page, so an interrupted import can be resumed
+        imported = 0
+        while True:
+            disqus_posts = disqus_client.list_posts(disqus_forum, disqus_posts_include, cursor)
+            disqus_posts_list = disqus_posts['response']
             print('Fetched', len(disqus_posts_list), 'posts')
-            if disqus_posts.cursor.get('hasNext', False):
-                print('Fetching more posts')
-                disqus_posts = disqus_api.posts.list(forum=disqus_forum,
-                                                     include=disqus_posts_include,
-                                                     order='asc',
-                                                     cursor=disqus_posts.cursor.get('next'))
-            else:
+
+            has_next = disqus_posts['cursor'].get('hasNext', False) and len(disqus_posts_list)
+            if has_next:
+                cursor = disqus_posts['cursor'].get('next')
+
+            checkpoint.cursor = cursor or ''
+            if disqus_posts_list:
+                checkpoint.last_post_id = int(disqus_posts_list[-1].get('id'))
+            posts = self.import_posts(disqus_client, disqus_forum, disqus_posts_list, options['workers'], checkpoint)
+
+            imported += len(posts)
+            print('Imported', imported, 'posts')
+
+            if not has_next:
                 break
 
+        imported += self.resolve_deferred(disqus_client, disqus_forum, options['workers'])
+
+        self.stdout.write('Successfully imported %d Disqus comments and authors from JSON API' % imported)
+
+    def import_posts(self, disqus_client, disqus_forum, disqus_posts_list, workers, checkpoint=None):
+        # Posts that have already been imported are skipped, so re-runs are idempotent
+        post_ids = [int(disqus_post.get('id')) for disqus_post in disqus_posts_list]
+        existing_post_ids = set(Post.objects.filter(id__in=post_ids).values_list('id', flat=True))
+        disqus_posts_list = [disqus_post for disqus_post in disqus_posts_list
+                             if not int(disqus_post.get('id')) in existing_post_ids]
+
+        parent_ids = set(int(disqus_post.get('parent')) for disqus_post in disqus_posts_list if disqus_post.get('parent'))
+        parent_ids -= set(int(disqus_post.get('id')) for disqus_post in disqus_posts_list)
+        parents = Post.objects.filter(id__in=parent_ids).only('id', 'thread', 'path', 'depth')
+        parents = {parent.id: parent for parent in parents}
+
+        disqus_posts_tree, disqus_posts_deferred = self.build_tree(disqus_posts_list, parents)
+
+        # Fetch everything from the network before touching the database
+        self.fetch_resources(disqus_client, disqus_posts_tree, workers)
+
         with transaction.atomic():
-            self.handle_post(disqus_api, disqus_posts_list)
+            posts = self.handle_posts(disqus_posts_tree)
+            self.defer_posts(disqus_forum, disqus_posts_deferred)
+            if checkpoint:
+                checkpoint.save()
+
+        # The bulk inserts skip the post_save signal, so clean the content in one pass
+        for post_ids in chunked(post.id for post in posts):
+            clean_posts(post_ids)
+
+        return posts
+
+    def defer_posts(self, disqus_forum, disqus_posts_deferred):
+        # Replies whose parents have not been imported yet are linked at the end
+        post_ids = [int(disqus_post.get('id')) for disqus_post in disqus_posts_deferred]
+        existing_post_ids = set(ImportDeferredPost.objects.filter(forum=disqus_forum, post_id__in=post_ids)
+                                                          .values_list('post_id', flat=True))
+        ImportDeferredPost.objects.bulk_create([ImportDeferredPost(forum=disqus_forum,
+                                                                   post_id=int(disqus_post.get('id')),
+                                                                   parent_id=int(disqus_post.get('parent')),
+                                                                   data=json.dumps(disqus_post))
+                                                for disqus_post in disqus_posts_deferred
+                                                if not int(disqus_post.get('id')) in existing_post_ids],
+                                               batch_size=BATCH_SIZE)
+        if disqus_posts_deferred:
+            print('Deferred', len(disqus_posts_deferred), 'replies')
+
+    def resolve_deferred(self, disqus_client, disqus_forum, workers):
+        imported = 0
+        while True:
+            deferred_posts = list(ImportDeferredPost.objects.filter(forum=disqus_forum).order_by('post_id'))
+            if not deferred_posts:
+                break
+
+            posts = self.import_posts(disqus_client, disqus_forum,
+                                      [json.loads(deferred_post.data) for deferred_post in deferred_posts], workers)
+            post_ids = set(post.id for post in posts)
+            ImportDeferredPost.objects.filter(forum=disqus_forum, post_id__in=post_ids).delete()
+            ImportDeferredPost.objects.filter(forum=disqus_forum, post_id__in=Post.objects.values('id')).delete()
+            imported += len(posts)
+
+            if not posts:
+                print('Could not link', len(deferred_posts), 'replies to their parents')
+                break
 
-        self.stdout.write('Successfully imported Disqus comments and authors from JSON API')
+        return imported
 
-    def handle_post(self, disqus_api, disqus_posts_list, parent_id=None, parent=None, depth=0):
+    def build_tree(self, disqus_posts_list, parents):
+        disqus_posts_children = {}
         for disqus_post in disqus_posts_list:
             post_parent_id = disqus_post.get('parent', None)
             if post_parent_id:
                 post_parent_id = int(post_parent_id)
-            if post_parent_id == parent_id:
-                post_id = int(disqus_post.get('id'))
+            disqus_posts_children.setdefault(post_parent_id, []).append(disqus_post)
 
-                print('\t'*depth, post_id)
+        # Walk the reply tree once, so that parents are always inserted first
+        disqus_posts_tree = []
+        stack = []
+        for parent_id in [None] + list(parents):
+            for disqus_post in reversed(disqus_posts_children.pop(parent_id, [])):
+                stack.append((disqus_post, parents.get(parent_id)))
+        while stack:
+            disqus_post, parent = stack.pop()
+            post = self.build_post(disqus_post, parent)
+            disqus_posts_tree.append((disqus_post, post))
+            for disqus_child in reversed(disqus_posts_children.pop(post.id, [])):
+                stack.append((disqus_child, post))
 
-                post_message = disqus_post.get('message')
-                post_created = disqus_post.get('createdAt')
+        # Everything left over is waiting for a parent from a later page
+        disqus_posts_deferred = [disqus_post for disqus_posts in disqus_posts_children.values()
+                                 for disqus_post in disqus_posts]
 
-                post_is_deleted     = disqus_post.get('isDeleted',     False)
-                post_is_approved    = disqus_post.get('isApproved',    True )
-                post_is_flagged     = disqus_post.get('isFlagged',     False)
-                post_is_spam        = disqus_post.get('isSpam',        False)
-                post_is_highlighted = disqus_post.get('isHighlighted', False)
+        return disqus_posts_tree, disqus_posts_deferred
 
-                disqus_author = disqus_post.get('author')
-
-                author = self.handle_author(post_id, disqus_author)
-
-                if not parent is None:
-                    thread = parent.thread
-                else:
-                    thread = Thread.objects.create(category='discussion')
-                    thread.crdate = self.parse_datetime(post_created)
-                    thread.save(update_fields=('crdate',))
-
-                post = Post.objects.create(id=post_id, parent=parent, thread=thread, author=author,
-                                           content=post_message, is_deleted=post_is_deleted,
-                                           is_approved=post_is_approved, is_flagged=post_is_flagged,
-                                           is_spam=post_is_spam, is_highlighted=post_is_highlighted)
-                post.crdate = self.parse_datetime(post_created)
-                post.save(update_fields=('crdate',))
+    def fetch_resources(self, disqus_client, disqus_posts_tree, workers):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            voters_futures = []
+            media_futures = []
+            for disqus_post, post in disqus_posts_tree:
+                post.import_voters = []
+                post.import_media = []
 
                 disqus_post_thread = int(disqus_post.get('thread'))
                 disqus_post_likes = int(disqus_post.get('likes', 0))
                 disqus_post_dislikes = int(disqus_post.get('dislikes', 0))
 
                 if disqus_post_likes > 0:
-                    self.handle_votes(disqus_api, disqus_post_thread, post,  1, disqus_post_likes)
+                    voters_futures.append((post, 1, executor.submit(disqus_client.list_voters,
+                                                                    disqus_post_thread, post.id, 1, disqus_post_likes)))
                 if disqus_post_dislikes > 0:
-                    self.handle_votes(disqus_api, disqus_post_thread, post, -1, disqus_post_dislikes)
-
-                disqus_post_media = disqus_post.get('media', [])
-                if disqus_post_media:
-                    self.handle_media(disqus_post_media, post)
-
-                self.handle_post(disqus_api, disqus_posts_list, post_id, post, depth+1)
-
-    def handle_author(self, post_id, disqus_author):
-        author_name         = disqus_author.get('name'       )
-        author_id           = disqus_author.get('id'         , None)
-        author_username     = disqus_author.get('username'   , None)
-        author_is_anonymous = disqus_author.get('isAnonymous', True)
-        author_joined       = disqus_author.get('joinedAt'   , None)
-
-        assert bool(author_is_anonymous) ^ bool(author_id)
-
-        if author_is_anonymous:
-            author_username = u'anonymous-%d' % post_id
-            author = Author.objects.create_user(username=author_username,
-                                                first_name=author_name)
-            author.is_active = False
-            author.save(update_fields=('is_active',))
-
-            return author
-
-        try:
-            author = Author.objects.get(id=int(author_id),
-                                        is_active=True)
-            print('MATCH:', author_id, author)
-
-        except Author.DoesNotExist:
-            author = Author.objects.create_user(id=int(author_id),
-                                                username=author_username,
-                                                first_name=author_name)
-            author.date_joined = self.parse_datetime(author_joined)
-            author.save(update_fields=('date_joined',))
-
-            user = User.objects.get(id=author.id)
-            UserSocialAuth.objects.create(user=user,
-                                          provider='disqus',
-                                          uid=author_id)
-
-        print(author.username)
-        return author
-
-    def handle_votes(self, disqus_api, disqus_post_thread, post, vote, votes):
-        users = disqus_api.posts.listUsersVotedPost(method='GET', thread=disqus_post_thread, post=post.id, vote=vote, limit=votes)
-
-        for user in users:
-            user_id = int(user.get('id', 0))
-            if user_id:
-                if User.objects.filter(id=user_id).exists():
-                    user = User.objects.get(id=user_id)
-                    Vote.objects.create(post=post, user=user, mode=vote)
-
-    def handle_media(self, disqus_post_media, post):
-        for disqus_media in disqus_post_media:
-            disqus_media_location = disqus_media.get('location', None)
-            if disqus_media_location:
-                disqus_media_filename = os.path.basename(disqus_media_location)
-                if disqus_media_location.startswith('//'):
-                    disqus_media_location = 'https:%s' % disqus_media_location
+                    voters_futures.append((post, -1, executor.submit(disqus_client.list_voters,
+                                                                     disqus_post_thread, post.id, -1, disqus_post_dislikes)))
+
+                for disqus_media in disqus_post.get('media', []):
+                    disqus_media_location = disqus_media.get('location', None)
+                    if disqus_media_location:
+                        disqus_media_filename = os.path.basename(disqus_media_location)
+                        if disqus_media_location.startswith('//'):
+                            disqus_media_location = 'https:%s' % disqus_media_location
+                        media_futures.append((post, disqus_media_filename,
+                                              executor.submit(disqus_client.fetch, disqus_media_location)))
+
+            for post, vote, future in voters_futures:
+                for user in future.result():
+                    user_id = int(user.get('id', 0))
+                    if user_id:
+                        post.import_voters.append((user_id, vote))
+            print('Fetched voters of', len(voters_futures), 'posts')
+
+            for post, disqus_media_filename, future in media_futures:
                 try:
-                    media_url = urllib.request.urlopen(disqus_media_location)
-                except urllib.request.HTTPError:
-                    continue
-                if media_url:
-                    media_data = media_url.read()
-                    media_file = ContentFile(media_data)
-                    media = Media(post=post)
-                    media.image.save(name=disqus_media_filename, content=media_file)
-                    media.save()
+                    post.import_media.append((disqus_media_filename, future.result()))
+                except (urllib.error.URLError, socket.timeout, ConnectionError) as e:
+                    print('Skipping media', disqus_media_filename, e)
+            print('Fetched', len(media_futures), 'media')
+
+    def handle_posts(self, disqus_posts_tree):
+        self.handle_authors(disqus_posts_tree)
+        self.handle_threads(disqus_posts_tree)
+        self.handle_votes(disqus_posts_tree)
+
+        posts = [post for disqus_post, post in disqus_posts_tree]
+        crdates = [post.crdate for post in posts]
+        Post.objects.bulk_create(posts, batch_size=BATCH_SIZE)
+        restore_crdates(Post, posts, crdates)
+
+        Vote.objects.bulk_create([vote for post in posts for vote in post.import_votes], batch_size=BATCH_SIZE)
+
+        for disqus_post, post in disqus_posts_tree:
+            if post.import_media:
+                self.handle_media(post.import_media, post)
+
+        # Replies can also be added to threads imported with earlier pages
+        for thread in Thread.objects.filter(id__in=set(post.thread_id for post in posts)):
+            thread.update_summary()
+            touch_version(thread.category, thread.id)
+
+        return posts
+
+    def build_post(self, disqus_post, parent):
+        post_id = int(disqus_post.get('id'))
+        post_path = get_path_segment(post_id)
+        post_depth = 0
+        if not parent is None:
+            post_path = parent.path + post_path
+            post_depth = parent.depth + 1
+
+        return Post(id=post_id, parent=parent,
+                    content=disqus_post.get('message'),
+                    crdate=self.parse_datetime(disqus_post.get('createdAt')),
+                    is_deleted=disqus_post.get('isDeleted', False),
+                    is_approved=disqus_post.get('isApproved', True),
+                    is_flagged=disqus_post.get('isFlagged', False),
+                    is_spam=disqus_post.get('isSpam', False),
+                    is_highlighted=disqus_post.get('isHighlighted', False),
+                    path=post_path, depth=post_depth)
+
+    def handle_threads(self, disqus_posts_tree):
+        post_threads = []
+        for disqus_post, post in disqus_posts_tree:
+            if post.parent is None:
+                post_threads.append((post, Thread(category='discussion', crdate=post.crdate)))
+        threads = [thread for post, thread in post_threads]
+
+        crdates = [thread.crdate for thread in threads]
+        if connection.features.can_return_ids_from_bulk_insert:
+            Thread.objects.bulk_create(threads, batch_size=BATCH_SIZE)
+        else:
+            for thread in threads:
+                thread.save()
+        restore_crdates(Thread, threads, crdates)
+
+        for post, thread in post_threads:
+            post.thread = thread
+        for disqus_post, post in disqus_posts_tree:
+            if not post.parent is None:
+                post.thread_id = post.parent.thread_id
+
+        return threads
+
+    def handle_authors(self, disqus_posts_tree):
+        anonymous_authors = []
+        disqus_authors = {}
+        for disqus_post, post in disqus_posts_tree:
+            disqus_author = disqus_post.get('author')
+
+            author_name         = disqus_author.get('name'       )
+            author_id           = disqus_author.get('id'         , None)
+            author_username     = disqus_author.get('username'   , None)
+            author_is_anonymous = disqus_author.get('isAnonymous', True)
+            author_joined       = disqus_author.get('joinedAt'   , None)
+
+            assert bool(author_is_anonymous) ^ bool(author_id)
+
+            if author_is_anonymous:
+                author = User(username=u'anonymous-%d' % post.id,
+                              first_name=author_name, is_active=False)
+                author.set_unusable_password()
+                anonymous_authors.append((author, post))
+                continue
+
+            post.author_id = int(author_id)
+            if not post.author_id in disqus_authors:
+                author = User(id=post.author_id, username=author_username, first_name=author_name,
+                              date_joined=self.parse_datetime(author_joined))
+                author.set_unusable_password()
+                disqus_authors[post.author_id] = author
+
+        existing_author_ids = set()
+        for author_ids in chunked(disqus_authors):
+            existing_author_ids.update(User.objects.filter(id__in=author_ids, is_active=True).values_list('id', flat=True))
+        print('Matched', len(existing_author_ids), 'authors')
+
+        new_authors = [author for author_id, author in disqus_authors.items() if not author_id in existing_author_ids]
+        User.objects.bulk_create(new_authors, batch_size=BATCH_SIZE)
+        UserSocialAuth.objects.bulk_create([UserSocialAuth(user_id=author.id, provider='disqus', uid=str(author.id))
+                                            for author in new_authors], batch_size=BATCH_SIZE)
+        print('Created', len(new_authors), 'authors')
+
+        # The ids of the anonymous authors are generated by the database
+        User.objects.bulk_create([author for author, post in anonymous_authors], batch_size=BATCH_SIZE)
+        for anonymous_chunk in chunked(anonymous_authors):
+            author_ids = User.objects.filter(username__in=[author.username for author, post in anonymous_chunk])
+            author_ids = dict(author_ids.values_list('username', 'id'))
+            for author, post in anonymous_chunk:
+                post.author_id = author_ids[author.username]
+        print('Created', len(anonymous_authors), 'anonymous authors')
+
+    def handle_votes(self, disqus_posts_tree):
+        voter_ids = set(user_id for disqus_post, post in disqus_posts_tree for user_id, vote in post.import_voters)
+        existing_voter_ids = set()
+        for user_ids in chunked(voter_ids):
+            existing_voter_ids.update(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+
+        for disqus_post, post in disqus_posts_tree:
+            post.import_votes = [Vote(post=post, user_id=user_id, mode=vote)
+                                 for user_id, vote in post.import_voters if user_id in existing_voter_ids]
+            post.vote_sum = sum(vote.mode for vote in post.import_votes)
+            post.upvotes = sum(1 for vote in post.import_votes if vote.mode > 0)
+            post.downvotes = sum(1 for vote in post.import_votes if vote.mode < 0)
+
+    def handle_media(self, import_media, post):
+        for media_filename, media_data in import_media:
+            media_file = ContentFile(media_data)
+            media = Media(post=post)
+            media.image.save(name=media_filename, content=media_file, save=False)
+            media.save()
 
     def parse_datetime(self, datetime):
         return timezone.make_aware(isodate.parse_datetime(datetime), timezone.utc)
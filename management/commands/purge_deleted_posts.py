@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from ...tasks import get_purge_age, iter_purge_reports, purge_orphaned_threads
+
+class Command(BaseCommand):
+    help = 'Purge soft-deleted posts and threads along with their votes and files in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report what would be purged')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of deleted posts to purge at once')
+        parser.add_argument('--delay', type=float, default=1,
+                            help='Seconds to wait between two chunks')
+        parser.add_argument('--max-chunks', type=int, default=None,
+                            help='Stop after this number of chunks')
+
+    def handle(self, *args, **options):
+        delete_age = get_purge_age()
+
+        totals = dict.fromkeys(('posts', 'votes', 'media', 'attachments', 'threads'), 0)
+        for report in iter_purge_reports(delete_age, options['chunk_size'], options['delay'],
+                                         options['max_chunks'], options['dry_run']):
+            for name in totals:
+                totals[name] += report[name]
+            self.stdout.write('Processed chunk up to id %d: %d posts, %d votes, %d media, %d attachments, %d threads' % (
+                report['last_id'], report['posts'], report['votes'], report['media'],
+                report['attachments'], report['threads']))
+        totals['threads'] += purge_orphaned_threads(delete_age, options['chunk_size'], options['dry_run'])
+
+        if options['dry_run']:
+            message = 'Would purge %d posts, %d votes, %d media, %d attachments and %d threads'
+        else:
+            message = 'Successfully purged %d posts, %d votes, %d media, %d attachments and %d threads'
+        self.stdout.write(message % (totals['posts'], totals['votes'], totals['media'],
+                                     totals['attachments'], totals['threads']))
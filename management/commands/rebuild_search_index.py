@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+from ...models import Post
+from ...tasks import iter_post_id_chunks
+from ... import search
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of all cleaned posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of posts to index at once')
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            raise CommandError('The database has no full-text index to rebuild')
+
+        with transaction.atomic():
+            search.clear_index()
+            posts = Post.objects.exclude(content_cleaned__isnull=True)
+            count = 0
+            for post_ids in iter_post_id_chunks(posts, options['chunk_size']):
+                search.index_posts(Post.objects.filter(id__in=post_ids).only('id', 'content_cleaned'))
+                count += len(post_ids)
+                self.stdout.write('Indexed %d posts up to id %d' % (count, post_ids[-1]))
+
+        self.stdout.write('Successfully rebuilt search index of %d posts' % count)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.db import transaction
+from django.db.models import Sum, Case, When, IntegerField
+from django.core.management.base import BaseCommand
+from ...models import Post, Vote
+
+class Command(BaseCommand):
+    help = 'Rebuild the vote counts of all posts from the votes'
+
+    def handle(self, *args, **options):
+        upvotes = Sum(Case(When(mode=1, then=1), default=0, output_field=IntegerField()))
+        downvotes = Sum(Case(When(mode=-1, then=1), default=0, output_field=IntegerField()))
+
+        with transaction.atomic():
+            Post.objects.exclude(votes__isnull=False).exclude(vote_sum=0, upvotes=0, downvotes=0).update(vote_sum=0, upvotes=0, downvotes=0)
+
+            vote_counts = Vote.objects.values('post').annotate(vote_sum=Sum('mode'), upvotes=upvotes, downvotes=downvotes).order_by()
+            for vote_count in vote_counts:
+                Post.objects.filter(id=vote_count['post']).update(vote_sum=vote_count['vote_sum'],
+                                                                  upvotes=vote_count['upvotes'],
+                                                                  downvotes=vote_count['downvotes'])
+
+        self.stdout.write('Successfully rebuilt vote counts of %d posts' % len(vote_counts))
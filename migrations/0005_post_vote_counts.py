@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_vote_counts(apps, schema_editor):
+    Post = apps.get_model('comments', 'Post')
+    Vote = apps.get_model('comments', 'Vote')
+    upvotes = models.Sum(models.Case(models.When(mode=1, then=1), default=0, output_field=models.IntegerField()))
+    downvotes = models.Sum(models.Case(models.When(mode=-1, then=1), default=0, output_field=models.IntegerField()))
+    vote_counts = Vote.objects.values('post').annotate(vote_sum=models.Sum('mode'), upvotes=upvotes, downvotes=downvotes)
+    for vote_count in vote_counts.order_by():
+        Post.objects.filter(id=vote_count['post']).update(vote_sum=vote_count['vote_sum'],
+                                                          upvotes=vote_count['upvotes'],
+                                                          downvotes=vote_count['downvotes'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0004_auto_20190327_1951'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='vote_sum',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Vote sum'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='upvotes',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Upvotes'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='downvotes',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Downvotes'),
+        ),
+        migrations.RunPython(populate_vote_counts, migrations.RunPython.noop),
+    ]
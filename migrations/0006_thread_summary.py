@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_thread_summary(apps, schema_editor):
+    Thread = apps.get_model('comments', 'Thread')
+    Post = apps.get_model('comments', 'Post')
+    for thread in Thread.objects.all():
+        posts = Post.objects.filter(thread=thread)
+        replies = posts.exclude(parent=None).filter(is_deleted=False, is_spam=False)
+        first_post = posts.filter(parent=None).order_by('crdate', 'tstamp').first()
+        thread.reply_count = replies.filter(is_approved=True).count()
+        thread.staff_reply_count = replies.count()
+        thread.last_post_date = posts.aggregate(last_post_date=models.Max('crdate'))['last_post_date']
+        thread.first_staff_post = first_post
+        if first_post and not (first_post.is_deleted or first_post.is_spam) and first_post.is_approved:
+            thread.first_active_post = first_post
+        thread.save(update_fields=('reply_count', 'staff_reply_count', 'last_post_date',
+                                   'first_staff_post', 'first_active_post'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0005_post_vote_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='first_active_post',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comments.Post'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='first_staff_post',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comments.Post'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Replies'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='staff_reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Staff replies'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_post_date',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Date last posted'),
+        ),
+        migrations.RunPython(populate_thread_summary, migrations.RunPython.noop),
+    ]
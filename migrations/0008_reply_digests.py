@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('comments', '0007_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationSetting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('immediate_replies', models.BooleanField(default=False, verbose_name='Immediate reply notifications')),
+                ('user', models.OneToOneField(related_name='comments_notification_setting', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PendingReply',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('crdate', models.DateTimeField(auto_now_add=True, verbose_name='Date created')),
+                ('post', models.ForeignKey(related_name='pending_replies', to='comments.Post')),
+                ('user', models.ForeignKey(related_name='pending_replies', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='pendingreply',
+            unique_together=set([('user', 'post')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0009_post_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('forum', models.CharField(max_length=100, unique=True, verbose_name='Forum')),
+                ('cursor', models.CharField(blank=True, default='', max_length=250, verbose_name='Cursor')),
+                ('last_post_id', models.BigIntegerField(blank=True, null=True, verbose_name='Last post')),
+                ('tstamp', models.DateTimeField(auto_now=True, verbose_name='Date changed')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportDeferredPost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('forum', models.CharField(max_length=100, verbose_name='Forum')),
+                ('post_id', models.BigIntegerField(verbose_name='Post')),
+                ('parent_id', models.BigIntegerField(verbose_name='Parent')),
+                ('data', models.TextField(verbose_name='Data')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='importdeferredpost',
+            unique_together=set([('forum', 'post_id')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # The full-text index lives outside of the ORM, there is none on other databases
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("CREATE VIRTUAL TABLE comments_post_search USING fts5(content, tokenize='porter unicode61')")
+    elif vendor == 'postgresql':
+        schema_editor.execute('CREATE TABLE comments_post_search ('
+                              'post_id integer PRIMARY KEY REFERENCES comments_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+                              'document tsvector NOT NULL)')
+        schema_editor.execute('CREATE INDEX comments_post_search_idx ON comments_post_search USING GIN (document)')
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE comments_post_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0010_import_checkpoints'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+
+def populate_previews(apps, schema_editor):
+    Post = apps.get_model('comments', 'Post')
+    posts = Post.objects.exclude(content_cleaned__isnull=True).only('id', 'content_cleaned')
+    for post in posts.iterator():
+        preview = Truncator(strip_tags(post.content_cleaned)).chars(200)
+        Post.objects.filter(id=post.id).update(preview=preview)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0011_post_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='preview',
+            field=models.CharField(blank=True, default='', editable=False, max_length=250, verbose_name='Preview'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_approved', 'id'], name='comments_post_approved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_flagged', 'id'], name='comments_post_flagged_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_highlighted', 'id'], name='comments_post_highlight_idx'),
+        ),
+        migrations.RunPython(populate_previews, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0012_post_preview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaDerivative',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.FileField(max_length=250, upload_to='', verbose_name='Image')),
+                ('format', models.CharField(choices=[('jpeg', 'JPEG'), ('webp', 'WebP')], default='jpeg', max_length=10, verbose_name='Format')),
+                ('width', models.SmallIntegerField(verbose_name='Width')),
+                ('height', models.SmallIntegerField(verbose_name='Height')),
+                ('media', models.ForeignKey(related_name='derivatives', to='comments.Media')),
+            ],
+            options={
+                'ordering': ('width',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='mediaderivative',
+            unique_together=set([('media', 'format', 'width')]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def get_path_segment(post_id):
+    segment = ''
+    while post_id:
+        post_id, digit = divmod(post_id, 36)
+        segment = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + segment
+    return segment.rjust(7, '0')
+
+def populate_paths(apps, schema_editor):
+    Post = apps.get_model('comments', 'Post')
+    parent_ids = dict(Post.objects.values_list('id', 'parent_id'))
+    paths = {}
+    for post_id in parent_ids:
+        chain = []
+        while post_id and post_id not in paths:
+            chain.append(post_id)
+            post_id = parent_ids.get(post_id)
+        path = paths.get(post_id, '')
+        for chain_id in reversed(chain):
+            path += get_path_segment(chain_id)
+            paths[chain_id] = path
+    for post_id, path in paths.items():
+        Post.objects.filter(id=post_id).update(path=path, depth=len(path) // 7 - 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0013_media_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='path',
+            field=models.TextField(blank=True, db_index=True, default='', editable=False, verbose_name='Path'),
+        ),
+        migrations.RunPython(populate_paths, migrations.RunPython.noop),
+    ]
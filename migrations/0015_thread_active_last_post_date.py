@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_last_post_dates(apps, schema_editor):
+    Thread = apps.get_model('comments', 'Thread')
+    Post = apps.get_model('comments', 'Post')
+    active_posts = Post.objects.filter(is_deleted=False, is_spam=False, is_approved=True)
+    last_post_dates = dict(active_posts.values('thread').annotate(last_post_date=models.Max('crdate'))
+                                       .order_by().values_list('thread', 'last_post_date'))
+    for thread_id, last_post_date in Thread.objects.values_list('id', 'last_post_date'):
+        if last_post_dates.get(thread_id) != last_post_date:
+            Thread.objects.filter(id=thread_id).update(last_post_date=last_post_dates.get(thread_id))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0014_post_path_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_last_post_dates, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
-from django.db import models
-from django.db.models import Q, signals
+from django.db import models, transaction
+from django.db.models import Q, F, Sum, Max, Case, When, Exists, OuterRef, IntegerField, signals
 from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
-from django.utils import timezone, html, safestring
+from django.utils import timezone, safestring
 from django.dispatch import receiver
-import urllib.parse, hashlib, datetime
-import threading, bleach
+from . import sanitizer, authors, search
+import urllib.parse, hashlib, datetime, threading, contextlib
 
 class Author(User):
     class Meta:
@@ -51,8 +52,20 @@ class Thread(models.Model):
     is_closed = models.BooleanField(_('Is closed'), blank=True, default=False)
     is_deleted = models.BooleanField(_('Is deleted'), blank=True, default=False)
 
+    first_active_post = models.ForeignKey('Post', related_name='+', blank=True, null=True,
+                                          editable=False, on_delete=models.SET_NULL)
+    first_staff_post = models.ForeignKey('Post', related_name='+', blank=True, null=True,
+                                         editable=False, on_delete=models.SET_NULL)
+
+    reply_count = models.PositiveIntegerField(_('Replies'), default=0, editable=False)
+    staff_reply_count = models.PositiveIntegerField(_('Staff replies'), default=0, editable=False)
+    last_post_date = models.DateTimeField(_('Date last posted'), blank=True, null=True, editable=False)
+
     class Meta:
         ordering = ('-crdate', '-tstamp')
+        indexes = [
+            models.Index(fields=['category', 'is_closed', 'is_deleted', 'crdate'], name='comments_thread_listing_idx'),
+        ]
 
     def __str__(self):
         return self.get_category_display()
@@ -62,22 +75,92 @@ class Thread(models.Model):
         thread_link = reverse('comments:show_posts', kwargs=thread_kwargs)
         return thread_link
 
-    @property
-    def first_staff_post(self):
+    def update_summary(self):
+        is_reply = Q(parent__isnull=False)
+        is_visible = Q(is_deleted=False, is_spam=False)
+        is_active = is_visible & Q(is_approved=True)
+        # Only posts everybody can see count as activity, like in the listings
+        summary = self.posts.aggregate(
+            reply_count=Sum(Case(When(is_reply & is_active, then=1),
+                                 default=0, output_field=IntegerField())),
+            staff_reply_count=Sum(Case(When(is_reply & is_visible, then=1),
+                                       default=0, output_field=IntegerField())),
+            last_post_date=Max(Case(When(is_active, then='crdate'))))
+        summary['reply_count'] = summary['reply_count'] or 0
+        summary['staff_reply_count'] = summary['staff_reply_count'] or 0
+
+        # Staff visibility of the first post depends on its age, which is
+        # already taken care of by the thread listing
+        first_post = self.posts.filter(parent=None).first()
+        summary['first_staff_post'] = first_post
+        if first_post and not (first_post.is_deleted or first_post.is_spam) and first_post.is_approved:
+            summary['first_active_post'] = first_post
+        else:
+            summary['first_active_post'] = None
+
+        Thread.objects.filter(id=self.id).update(**summary)
+        for name, value in summary.items():
+            setattr(self, name, value)
+
+    def get_post_tree(self, staff=False):
+        # Load all visible posts at once and link the replies in memory
+        if staff:
+            posts = self.posts.staff()
+        else:
+            posts = self.posts.active()
+        posts = list(posts.prefetch_related('media__derivatives', 'attachments'))
+        authors.attach_author_cards(posts)
+
+        children = {}
+        for post in posts:
+            post.thread = self
+            children.setdefault(post.parent_id, []).append(post)
+
+        first_posts = children.get(None)
+        if not first_posts:
+            raise Post.DoesNotExist
+
+        # Replies hidden from this tree still keep their parents from being edited
+        parent_ids = set(self.posts.exclude(parent=None).order_by().values_list('parent_id', flat=True).distinct())
+        for post_list in children.values():
+            for post in post_list:
+                post.children = children.get(post.id, [])
+                post.is_replied = post.id in parent_ids
+
+        return first_posts[0]
+
+class PostQuerySet(models.QuerySet):
+    def staff(self):
         yesterday = timezone.now() - datetime.timedelta(days=1)
-        return self.posts.filter(parent=None).exclude(Q(is_deleted=True) | Q(is_spam=True), Q(tstamp__lt=yesterday)).get()
+        return self.exclude(Q(is_deleted=True) | Q(is_spam=True), Q(tstamp__lt=yesterday))
 
-    @property
-    def first_active_post(self):
-        return self.posts.filter(parent=None).exclude(Q(is_deleted=True) | Q(is_spam=True) | Q(is_approved=False)).get()
+    def active(self):
+        return self.exclude(Q(is_deleted=True) | Q(is_spam=True) | Q(is_approved=False))
+
+    def update_votes(self, upvotes=0, downvotes=0):
+        return self.update(vote_sum=F('vote_sum') + upvotes - downvotes,
+                           upvotes=F('upvotes') + upvotes,
+                           downvotes=F('downvotes') + downvotes)
+
+def get_path_segment(post_id):
+    segment = ''
+    while post_id:
+        post_id, digit = divmod(post_id, 36)
+        segment = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + segment
+    return segment.rjust(Post.PATH_SEGMENT_LENGTH, '0')
 
 class Post(models.Model):
+    # Every post stores the ids of its ancestors and itself as fixed-width
+    # base 36 segments, so that subtrees can be fetched with a prefix match
+    PATH_SEGMENT_LENGTH = 7
+
     parent = models.ForeignKey('self', related_name='posts', blank=True, null=True)
     thread = models.ForeignKey(Thread, related_name='posts')
     author = models.ForeignKey(Author, related_name='posts')
 
     content = models.TextField(_('Comment'))
     content_cleaned = models.TextField(null=True, editable=False)
+    preview = models.CharField(_('Preview'), max_length=250, blank=True, default='', editable=False)
 
     crdate = models.DateTimeField(_('Date created'), auto_now_add=True)
     tstamp = models.DateTimeField(_('Date changed'), auto_now=True)
@@ -89,12 +172,26 @@ class Post(models.Model):
     is_spam = models.BooleanField(_('Is spam'), blank=True, default=False)
     is_highlighted = models.BooleanField(_('Is highlighted'), blank=True, default=False)
 
-    cleaner_sem = threading.Semaphore()
-    cleaner = bleach.Cleaner(tags=('br', 'p', 'a', 'b', 'i', 'strong', 'em'),
-                             filters=[bleach.linkifier.LinkifyFilter])
+    vote_sum = models.IntegerField(_('Vote sum'), default=0, editable=False)
+    upvotes = models.PositiveIntegerField(_('Upvotes'), default=0, editable=False)
+    downvotes = models.PositiveIntegerField(_('Downvotes'), default=0, editable=False)
+
+    path = models.TextField(_('Path'), blank=True, default='', editable=False, db_index=True)
+    depth = models.PositiveSmallIntegerField(_('Depth'), default=0, editable=False)
+
+    objects = PostQuerySet.as_manager()
+
+    _author_card = None
 
     class Meta:
         ordering = ('crdate', 'tstamp')
+        indexes = [
+            models.Index(fields=['thread', 'parent', 'is_deleted', 'is_spam', 'is_approved'], name='comments_post_visibility_idx'),
+            models.Index(fields=['thread', 'tstamp'], name='comments_post_tstamp_idx'),
+            models.Index(fields=['is_approved', 'id'], name='comments_post_approved_idx'),
+            models.Index(fields=['is_flagged', 'id'], name='comments_post_flagged_idx'),
+            models.Index(fields=['is_highlighted', 'id'], name='comments_post_highlight_idx'),
+        ]
 
     def __str__(self):
         return '%s by %s' % (self.thread, self.author)
@@ -112,21 +209,25 @@ class Post(models.Model):
     get_cleaned_content.short_description = _('Comment')
 
     def fix_linebreaks(self, content):
-        content = content.replace('<p>', '')
-        content = content.replace('</p>', '\n\n')
-        content = content.replace('<br>', '\n')
-        content = content.replace('<br/>', '\n')
-        content = content.replace('<br />', '\n')
-        return html.linebreaks(content)
+        return sanitizer.fix_linebreaks(content)
 
     def clean_content(self, commit=True):
-        fixed_linebreaks = self.fix_linebreaks(self.content)
-        with self.cleaner_sem:
-            self.content_cleaned = self.cleaner.clean(fixed_linebreaks)
+        self.content_cleaned = sanitizer.clean_content(self.content)
+        self.preview = sanitizer.make_preview(self.content_cleaned)
         if commit and self.id:
-            self.save(update_fields=('content_cleaned',))
+            self.save(update_fields=('content_cleaned', 'preview'))
         return self.content_cleaned
 
+    @property
+    def author_card(self):
+        if self._author_card is None:
+            self._author_card = authors.get_author_card(self.author_id)
+        return self._author_card
+
+    @author_card.setter
+    def author_card(self, author_card):
+        self._author_card = author_card
+
     @property
     def cleaned_content(self):
         if not self.content_cleaned:
@@ -136,12 +237,11 @@ class Post(models.Model):
 
     @property
     def staff_posts(self):
-        yesterday = timezone.now() - datetime.timedelta(days=1)
-        return self.posts.exclude(Q(is_deleted=True) | Q(is_spam=True), Q(tstamp__lt=yesterday))
+        return self.posts.staff()
 
     @property
     def active_posts(self):
-        return self.posts.exclude(Q(is_deleted=True) | Q(is_spam=True) | Q(is_approved=False))
+        return self.posts.active()
 
     @property
     def is_editable(self):
@@ -150,13 +250,44 @@ class Post(models.Model):
         yesterday = timezone.now() - datetime.timedelta(days=1)
         if self.crdate < yesterday:
             return False
-        if self.posts.exists():
+        if self.has_replies:
             return False
         return True
 
     @property
-    def vote_sum(self):
-        return self.votes.aggregate(vote_sum=models.Sum('mode'))['vote_sum']
+    def has_replies(self):
+        # Posts of a tree from get_post_tree know about all their replies already,
+        # including those left out of the tree
+        is_replied = getattr(self, 'is_replied', None)
+        if is_replied is not None:
+            return is_replied
+        return self.posts.exists()
+
+    def update_path(self):
+        if self.parent_id:
+            self.path = self.parent.path + get_path_segment(self.id)
+            self.depth = self.parent.depth + 1
+        else:
+            self.path = get_path_segment(self.id)
+            self.depth = 0
+        Post.objects.filter(id=self.id).update(path=self.path, depth=self.depth)
+
+    def get_ancestor_ids(self):
+        return [int(self.path[index:index + self.PATH_SEGMENT_LENGTH], 36)
+                for index in range(0, len(self.path) - self.PATH_SEGMENT_LENGTH, self.PATH_SEGMENT_LENGTH)]
+
+    def get_ancestors(self):
+        return Post.objects.filter(id__in=self.get_ancestor_ids()).order_by('depth')
+
+    def get_descendants(self, max_depth=None):
+        descendants = Post.objects.filter(path__startswith=self.path).exclude(id=self.id)
+        if max_depth is not None:
+            descendants = descendants.filter(depth__lte=self.depth + max_depth)
+        return descendants
+
+    @property
+    def descendant_count(self):
+        return self.get_descendants().count()
 
 class Vote(models.Model):
     MODES = (
@@ -170,6 +301,21 @@ class Vote(models.Model):
 
     class Meta:
         unique_together = ('post', 'user')
+        indexes = [
+            models.Index(fields=['post', 'mode'], name='comments_vote_mode_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.saved_mode = instance.mode
+        return instance
+
+    @property
+    def vote_counts(self):
+        if self.mode > 0:
+            return {'upvotes': 1}
+        return {'downvotes': 1}
 
 class Media(models.Model):
     post = models.ForeignKey(Post, related_name='media')
@@ -179,11 +325,159 @@ class Media(models.Model):
     width = models.SmallIntegerField(_('Width'))
     height = models.SmallIntegerField(_('Height'))
 
+    @property
+    def thumbnails(self):
+        # Derivatives in the default format, smallest first
+        return [derivative for derivative in self.derivatives.all() if derivative.format == 'jpeg']
+
+    @property
+    def thumbnail(self):
+        thumbnails = self.thumbnails
+        return thumbnails[0] if thumbnails else None
+
+    def get_srcset(self, format='jpeg'):
+        return ', '.join('%s %dw' % (derivative.image.url, derivative.width)
+                         for derivative in self.derivatives.all() if derivative.format == format)
+
+    @property
+    def srcset(self):
+        return self.get_srcset()
+
+    @property
+    def webp_srcset(self):
+        return self.get_srcset('webp')
+
+class MediaDerivative(models.Model):
+    FORMAT_CHOICES = (
+        ('jpeg', _('JPEG')),
+        ('webp', _('WebP')),
+    )
+
+    media = models.ForeignKey(Media, related_name='derivatives')
+    image = models.FileField(_('Image'), max_length=250)
+    format = models.CharField(_('Format'), max_length=10, choices=FORMAT_CHOICES, default='jpeg')
+    width = models.SmallIntegerField(_('Width'))
+    height = models.SmallIntegerField(_('Height'))
+
+    class Meta:
+        ordering = ('width',)
+        unique_together = ('media', 'format', 'width')
+
 class Attachment(models.Model):
     post = models.ForeignKey(Post, related_name='attachments')
     file = models.FileField(_('File'), upload_to='comments/posts/%Y/%m/%d',
                                        max_length=250)
 
+class NotificationSetting(models.Model):
+    user = models.OneToOneField(User, related_name='comments_notification_setting')
+    immediate_replies = models.BooleanField(_('Immediate reply notifications'), blank=True, default=False)
+
+class PendingReply(models.Model):
+    user = models.ForeignKey(User, related_name='pending_replies')
+    post = models.ForeignKey(Post, related_name='pending_replies')
+    crdate = models.DateTimeField(_('Date created'), auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'post')
+
+class ImportCheckpoint(models.Model):
+    forum = models.CharField(_('Forum'), max_length=100, unique=True)
+    cursor = models.CharField(_('Cursor'), max_length=250, blank=True, default='')
+    last_post_id = models.BigIntegerField(_('Last post'), blank=True, null=True)
+    tstamp = models.DateTimeField(_('Date changed'), auto_now=True)
+
+class ImportDeferredPost(models.Model):
+    forum = models.CharField(_('Forum'), max_length=100)
+    post_id = models.BigIntegerField(_('Post'))
+    parent_id = models.BigIntegerField(_('Parent'))
+    data = models.TextField(_('Data'))
+
+    class Meta:
+        unique_together = ('forum', 'post_id')
+
+def get_version_key(category, thread_id=None):
+    if thread_id:
+        return 'comments:version:%s:%d' % (category, thread_id)
+    return 'comments:version:%s' % category
+
+def get_version(category, thread_id=None):
+    version_key = get_version_key(category, thread_id)
+    version = cache.get(version_key)
+    if not version:
+        version = timezone.now()
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return version
+
+def touch_version(category, thread_id=None):
+    version = timezone.now()
+    version_keys = [get_version_key(category)]
+    if thread_id:
+        version_keys.append(get_version_key(category, thread_id))
+    cache.set_many(dict.fromkeys(version_keys, version), None)
+
+def delete_post_fragments(post):
+    author_card = post.author_card
+    if author_card is None:
+        return
+    vary_on = (post.id, post.tstamp, post.vote_sum, post.upvotes, post.downvotes, author_card.version)
+    cache.delete(make_template_fragment_key('comments_post', vary_on))
+
+MODERATION_ACTIONS = {
+    'approve': ('is_approved', True),
+    'disapprove': ('is_approved', False),
+    'spam': ('is_spam', True),
+    'unspam': ('is_spam', False),
+    'delete': ('is_deleted', True),
+    'undelete': ('is_deleted', False),
+    'unflag': ('is_flagged', False),
+    'unhighlight': ('is_highlighted', False),
+}
+
+def moderate_posts(posts, action):
+    # Applies the action to all posts with one UPDATE and refreshes their threads
+    # like the single post views do, returns the ids of the changed posts
+    from .tasks import notification_posts_approved
+    field, value = MODERATION_ACTIONS[action]
+    changed_posts = list(posts.exclude(**{field: value}).values_list('id', 'thread_id'))
+    if not changed_posts:
+        return []
+    post_ids = [post_id for post_id, thread_id in changed_posts]
+    thread_ids = set(thread_id for post_id, thread_id in changed_posts)
+    now = timezone.now()
+
+    with transaction.atomic():
+        Post.objects.filter(id__in=post_ids).update(**{field: value, 'tstamp': now})
+
+        if field == 'is_deleted':
+            # Threads are deleted along with their last remaining post
+            remaining_posts = Post.objects.filter(thread=OuterRef('pk')).exclude(is_deleted=True)
+            threads = Thread.objects.filter(id__in=thread_ids)
+            threads = threads.annotate(has_posts=Exists(remaining_posts.values('id')))
+            for has_posts in (True, False):
+                changed_thread_ids = list(threads.filter(has_posts=has_posts).values_list('id', flat=True))
+                Thread.objects.filter(id__in=changed_thread_ids).update(is_deleted=not has_posts, tstamp=now)
+
+        for thread in Thread.objects.filter(id__in=thread_ids):
+            thread.update_summary()
+            touch_version(thread.category, thread.id)
+
+        if action == 'approve':
+            transaction.on_commit(lambda: notification_posts_approved.delay(post_ids))
+
+    return post_ids
+
+@receiver(signals.post_save, sender=User)
+@receiver(signals.post_save, sender=Author)
+def handle_user_post_save_signal(sender, instance, update_fields, **kwargs):
+    if not update_fields or not update_fields.isdisjoint(('username', 'first_name', 'email')):
+        authors.delete_author_card(instance.id)
+
+@receiver(signals.post_save, sender=Thread)
+@receiver(signals.post_delete, sender=Thread)
+def handle_thread_change_signal(sender, instance, **kwargs):
+    touch_version(instance.category, instance.id)
+
 @receiver(signals.pre_save, sender=Post)
 def handle_post_pre_save_signal(sender, instance, update_fields, **kwargs):
     if not update_fields or 'content' in update_fields:
@@ -192,5 +486,80 @@ def handle_post_pre_save_signal(sender, instance, update_fields, **kwargs):
 @receiver(signals.post_save, sender=Post)
 def handle_post_post_save_signal(sender, instance, update_fields, **kwargs):
     from .tasks import clean_post_content
+    if not instance.path:
+        instance.update_path()
     if not instance.content_cleaned:
         clean_post_content.apply_async(countdown=1, kwargs={'post_id': instance.id})
+    elif not update_fields or 'content_cleaned' in update_fields:
+        search.index_posts([instance])
+    if not update_fields or not update_fields.isdisjoint(('parent', 'is_deleted', 'is_approved', 'is_spam')):
+        instance.thread.update_summary()
+    touch_version(instance.thread.category, instance.thread_id)
+    delete_post_fragments(instance)
+
+post_signals_state = threading.local()
+
+@contextlib.contextmanager
+def defer_post_signals():
+    # Deleted posts leave their threads alone, the caller refreshes them once
+    post_signals_state.deferred = True
+    try:
+        yield
+    finally:
+        post_signals_state.deferred = False
+
+@receiver(signals.post_delete, sender=Post)
+def handle_post_post_delete_signal(sender, instance, **kwargs):
+    if getattr(post_signals_state, 'deferred', False):
+        return
+    search.unindex_posts([instance.id])
+    thread = Thread.objects.filter(id=instance.thread_id).first()
+    if thread:
+        thread.update_summary()
+        touch_version(thread.category, thread.id)
+    delete_post_fragments(instance)
+
+vote_counts_state = threading.local()
+
+@contextlib.contextmanager
+def defer_vote_counts():
+    # Vote signals leave the post counters alone, the caller recomputes them once
+    vote_counts_state.deferred = True
+    try:
+        yield
+    finally:
+        vote_counts_state.deferred = False
+
+def touch_vote_version(vote):
+    thread = Thread.objects.filter(posts=vote.post_id).values_list('id', 'category').first()
+    if thread:
+        touch_version(thread[1], thread[0])
+
+@receiver(signals.post_save, sender=Media)
+def handle_media_post_save_signal(sender, instance, created, update_fields, **kwargs):
+    from .tasks import create_media_derivatives
+    if created or not update_fields or 'image' in update_fields:
+        create_media_derivatives.apply_async(countdown=1, kwargs={'media_id': instance.id})
+
+@receiver(signals.post_save, sender=Vote)
+def handle_vote_post_save_signal(sender, instance, created, **kwargs):
+    if getattr(vote_counts_state, 'deferred', False):
+        return
+    saved_mode = getattr(instance, 'saved_mode', None)
+    if created:
+        Post.objects.filter(id=instance.post_id).update_votes(**instance.vote_counts)
+    elif saved_mode is not None and saved_mode != instance.mode:
+        if instance.mode > 0:
+            Post.objects.filter(id=instance.post_id).update_votes(upvotes=1, downvotes=-1)
+        else:
+            Post.objects.filter(id=instance.post_id).update_votes(upvotes=-1, downvotes=1)
+    instance.saved_mode = instance.mode
+    touch_vote_version(instance)
+
+@receiver(signals.post_delete, sender=Vote)
+def handle_vote_post_delete_signal(sender, instance, **kwargs):
+    if getattr(vote_counts_state, 'deferred', False):
+        return
+    vote_counts = {name: -count for name, count in instance.vote_counts.items()}
+    Post.objects.filter(id=instance.post_id).update_votes(**vote_counts)
+    touch_vote_version(instance)
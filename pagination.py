@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+import base64, datetime
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_cursor(crdate, id):
+    microseconds = (crdate - EPOCH) // datetime.timedelta(microseconds=1)
+    value = '%d:%d' % (microseconds, id)
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        microseconds, id = value.split(':')
+        return EPOCH + datetime.timedelta(microseconds=int(microseconds)), int(id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor: %r' % cursor)
+
+class CursorPage(object):
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return encode_cursor(self.object_list[-1].crdate, self.object_list[-1].id)
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor(self.object_list[0].crdate, self.object_list[0].id)
+        return None
+
+class CursorPaginator(object):
+    # Pages through a queryset newest first using (crdate, id) as the key, so
+    # every page costs the same independent of its position
+    def __init__(self, object_list, per_page):
+        self.object_list = object_list
+        self.per_page = per_page
+
+    def page(self, after=None, before=None):
+        if before:
+            crdate, id = decode_cursor(before)
+            object_list = self.object_list.filter(Q(crdate__gt=crdate) | Q(crdate=crdate, id__gt=id))
+            object_list = list(object_list.order_by('crdate', 'id')[:self.per_page + 1])
+            if len(object_list) <= self.per_page:
+                return self.page()
+            return CursorPage(object_list[:self.per_page][::-1], True, True)
+
+        object_list = self.object_list
+        if after:
+            crdate, id = decode_cursor(after)
+            object_list = object_list.filter(Q(crdate__lt=crdate) | Q(crdate=crdate, id__lt=id))
+        object_list = list(object_list.order_by('-crdate', '-id')[:self.per_page + 1])
+        return CursorPage(object_list[:self.per_page], len(object_list) > self.per_page, bool(after))
+
+    def page_cursor(self, number):
+        # Cursor of the given page number, for translating old ?page= links
+        offset = (number - 1) * self.per_page
+        if offset <= 0:
+            return None
+        object_list = self.object_list.order_by('-crdate', '-id').values_list('crdate', 'id')
+        for crdate, id in object_list[offset - 1:offset]:
+            return encode_cursor(crdate, id)
+        raise ValueError('Page %d is out of range' % number)
+
+class EstimatedCountPaginator(Paginator):
+    # Unfiltered tables on PostgreSQL are counted from the planner statistics
+    # instead of a full scan, everything else is counted exactly
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [self.object_list.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > 10000:
+                return int(row[0])
+        return super().count
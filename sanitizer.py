@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.utils import html
+from django.utils.text import Truncator
+import threading, bleach
+
+ALLOWED_TAGS = ('br', 'p', 'a', 'b', 'i', 'strong', 'em')
+
+PREVIEW_LENGTH = 200
+
+cleaners = threading.local()
+
+def get_cleaner():
+    # bleach.Cleaner instances are not thread-safe, so every thread gets its own
+    cleaner = getattr(cleaners, 'cleaner', None)
+    if cleaner is None:
+        cleaner = bleach.Cleaner(tags=ALLOWED_TAGS,
+                                 filters=[bleach.linkifier.LinkifyFilter])
+        cleaners.cleaner = cleaner
+    return cleaner
+
+def fix_linebreaks(content):
+    content = content.replace('<p>', '')
+    content = content.replace('</p>', '\n\n')
+    content = content.replace('<br>', '\n')
+    content = content.replace('<br/>', '\n')
+    content = content.replace('<br />', '\n')
+    return html.linebreaks(content)
+
+def clean_content(content):
+    return get_cleaner().clean(fix_linebreaks(content))
+
+def make_preview(content_cleaned):
+    return Truncator(html.strip_tags(content_cleaned)).chars(PREVIEW_LENGTH)
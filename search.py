@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import connection
+from django.utils.html import strip_tags
+import re
+
+SEARCH_TABLE = 'comments_post_search'
+
+def get_config():
+    return getattr(settings, 'COMMENTS_SEARCH_CONFIG', 'english')
+
+def is_supported():
+    return connection.vendor in ('sqlite', 'postgresql')
+
+def get_document(post):
+    return strip_tags(post.content_cleaned)
+
+def get_match_query(query):
+    # Every word is quoted, so user input never breaks the FTS5 query syntax
+    return ' '.join('"%s"' % word for word in re.findall(r'\w+', query))
+
+def index_posts(posts):
+    posts = [post for post in posts if post.content_cleaned is not None]
+    if not posts or not is_supported():
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (SEARCH_TABLE, ', '.join(['%s'] * len(posts))),
+                           [post.id for post in posts])
+            cursor.executemany('INSERT INTO %s (rowid, content) VALUES (%%s, %%s)' % SEARCH_TABLE,
+                               [(post.id, get_document(post)) for post in posts])
+        else:
+            cursor.executemany('INSERT INTO %s (post_id, document) VALUES (%%s, to_tsvector(%%s::regconfig, %%s)) '
+                               'ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document' % SEARCH_TABLE,
+                               [(post.id, get_config(), get_document(post)) for post in posts])
+
+def unindex_posts(post_ids):
+    post_ids = list(post_ids)
+    if not post_ids or not is_supported():
+        return
+    column = 'rowid' if connection.vendor == 'sqlite' else 'post_id'
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (SEARCH_TABLE, column, ', '.join(['%s'] * len(post_ids))),
+                       post_ids)
+
+def clear_index():
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s' % SEARCH_TABLE)
+
+def search_posts(posts, query):
+    # Returns the posts matching the query, best matches first
+    post_table = posts.model._meta.db_table
+    if connection.vendor == 'sqlite':
+        match_query = get_match_query(query)
+        if not match_query:
+            return posts.none()
+        return posts.extra(tables=[SEARCH_TABLE],
+                           where=['%s.rowid = %s.id' % (SEARCH_TABLE, post_table), '%s MATCH %%s' % SEARCH_TABLE],
+                           params=[match_query],
+                           select={'rank': 'bm25(%s)' % SEARCH_TABLE},
+                           order_by=['rank', '-crdate'])
+    if connection.vendor == 'postgresql':
+        ts_query = 'plainto_tsquery(%s::regconfig, %s)'
+        return posts.extra(tables=[SEARCH_TABLE],
+                           where=['%s.post_id = %s.id' % (SEARCH_TABLE, post_table),
+                                  '%s.document @@ %s' % (SEARCH_TABLE, ts_query)],
+                           params=[get_config(), query],
+                           select={'rank': 'ts_rank(%s.document, %s)' % (SEARCH_TABLE, ts_query)},
+                           select_params=[get_config(), query],
+                           order_by=['-rank', '-crdate'])
+    # Other databases have no full-text index, fall back to a plain scan
+    return posts.filter(content_cleaned__icontains=query).order_by('-crdate')
@@ -1,8 +1,84 @@
 # -*- coding: utf-8 -*-
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator
+from django.core.paginator import Page, EmptyPage, PageNotAnInteger
+from django.core.cache import cache
 from django.contrib.sitemaps import Sitemap
+from django.db.models import Q, Count, Max, Exists, OuterRef
 from .models import Thread, Post
+from .pagination import encode_cursor
+
+thread_link_formats = {}
+
+def get_thread_link(category, thread_id):
+    # Reverse only once per category and fill in the thread ids afterwards
+    if not category in thread_link_formats:
+        thread_link = reverse('comments:show_posts', kwargs={'category': category, 'thread_id': 0})
+        prefix, suffix = thread_link.rsplit('0', 1)
+        thread_link_formats[category] = (prefix, suffix)
+    prefix, suffix = thread_link_formats[category]
+    return '%s%d%s' % (prefix, thread_id, suffix)
+
+class SectionPaginator(object):
+    # Splits the items into sections of consecutive ids holding up to per_page
+    # items each. The section boundaries are kept in the cache and only
+    # extended once the last section runs full, so no full count is needed.
+    def __init__(self, object_list, per_page, cache_key):
+        self.object_list = object_list.order_by('id')
+        self.per_page = per_page
+        self.cache_key = cache_key
+        self.boundaries = self.get_boundaries()
+
+    def get_boundaries(self):
+        boundaries = cache.get(self.cache_key) or [0]
+        object_list = self.object_list.filter(id__gte=boundaries[-1])
+        if object_list[self.per_page:self.per_page + 1].exists():
+            for index, id in enumerate(object_list.values_list('id', flat=True).iterator()):
+                if index and index % self.per_page == 0:
+                    boundaries.append(id)
+            cache.set(self.cache_key, boundaries, None)
+        return boundaries
+
+    @property
+    def num_pages(self):
+        return len(self.boundaries)
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1 or number > self.num_pages:
+            raise EmptyPage('That page contains no results')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        object_list = self.object_list.filter(id__gte=self.boundaries[number - 1])
+        if number < self.num_pages:
+            object_list = object_list.filter(id__lt=self.boundaries[number])
+        return Page(object_list, number, self)
+
+class SectionSitemap(Sitemap):
+    limit = 5000
+
+    @property
+    def paginator(self):
+        cache_key = 'comments:sitemap:%s:sections' % self.__class__.__name__
+        return SectionPaginator(self.items(), self.limit, cache_key)
+
+    def get_urls(self, page=1, site=None, protocol=None):
+        # Sections are only rendered again once their items change
+        section = self.paginator.page(page)
+        summary = section.object_list.aggregate(count=Count('id'), lastmod=Max('tstamp'))
+        cache_key = 'comments:sitemap:%s:%s:%s:%d:%d:%s' % (self.__class__.__name__, protocol,
+                                                            site.domain if site else '', section.number,
+                                                            summary['count'], summary['lastmod'])
+        urls = cache.get(cache_key)
+        if urls is None:
+            urls = [dict(url, item=None) for url in super().get_urls(page, site, protocol)]
+            cache.set(cache_key, urls, 86400)
+        self.latest_lastmod = summary['lastmod']
+        return urls
 
 class CategorySitemap(Sitemap):
     changefreq = 'daily'
@@ -12,35 +88,65 @@ class CategorySitemap(Sitemap):
     def __init__(self, category):
         self.category = category
 
+    # Every request adds the page positions of at most this many threads
+    max_new_threads = 10000
+
     def items(self):
+        # The same threads as the listing of all threads, oldest first. Pages
+        # are counted from the oldest thread on, so their positions stay valid
+        # and new threads only extend the newest page. The positions are kept
+        # in the cache and extended by the threads added since.
+        first_posts = Post.objects.filter(thread=OuterRef('pk'), parent=None).active()
         threads = Thread.objects.filter(category=self.category).exclude(is_deleted=True)
-        paginator = Paginator(threads, 10)
-        return paginator.page_range
+        threads = threads.annotate(has_first_post=Exists(first_posts.values('id'))).filter(has_first_post=True)
+        threads = threads.order_by('crdate', 'id').values_list('crdate', 'id')
 
-    def location(self, page):
-        category_kwargs = {'category': self.category}
+        cache_key = 'comments:sitemap:%s:positions' % self.category
+        positions = cache.get(cache_key) or []
+        if positions:
+            # A page lists the 10 threads older than its position
+            crdate, id = positions[-1]
+            threads = threads.filter(Q(crdate__gt=crdate) | Q(crdate=crdate, id__gt=id))
+            new_positions = list(threads[:self.max_new_threads])[9::10]
+        else:
+            new_positions = list(threads[:self.max_new_threads])[10::10]
+        if new_positions:
+            positions += new_positions
+            cache.set(cache_key, positions, None)
+        return [None] + [encode_cursor(crdate, id) for crdate, id in reversed(positions)]
+
+    def location(self, cursor):
+        category_kwargs = {'category': self.category, 'filter': 'all'}
         category_link = reverse('comments:show_threads', kwargs=category_kwargs)
-        category_link += '?page=%d' % page
+        if cursor:
+            category_link += '?after=%s' % cursor
         return category_link
 
-class ThreadSitemap(Sitemap):
+class ThreadSitemap(SectionSitemap):
     changefreq = 'daily'
     protocol = 'https'
     priority = 0.5
 
     def items(self):
-        return Thread.objects.exclude(is_deleted=True)
+        return Thread.objects.exclude(is_deleted=True).only('id', 'category', 'tstamp')
+
+    def location(self, thread):
+        return get_thread_link(thread.category, thread.id)
 
     def lastmod(self, thread):
         return thread.tstamp
 
-class PostSitemap(Sitemap):
+class PostSitemap(SectionSitemap):
     changefreq = 'daily'
     protocol = 'https'
     priority = 0.4
 
     def items(self):
-        return Post.objects.exclude(is_deleted=True).exclude(is_spam=True).filter(is_approved=True)
+        posts = Post.objects.exclude(is_deleted=True).exclude(is_spam=True).filter(is_approved=True)
+        return posts.select_related('thread').only('id', 'tstamp', 'thread__id', 'thread__category')
+
+    def location(self, post):
+        return '%s#p%d' % (get_thread_link(post.thread.category, post.thread_id), post.id)
 
     def lastmod(self, post):
         return post.tstamp
@@ -1,45 +1,84 @@
 # -*- coding: utf-8 -*-
 from celery.schedules import crontab
 from celery.task import task, periodic_task
-from django.db.models import Q
+from django.conf import settings
+from django.db import transaction, IntegrityError, DataError
+from django.db.models import Q, Sum, Case, When, Value, Exists, OuterRef, TextField, IntegerField
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.contrib.auth.models import User, Permission
 from django.contrib.sites.models import Site
 from django.utils import timezone
-from .models import User, Post, Thread
-import datetime
+from .models import User, Post, Thread, Vote, Media, MediaDerivative, Attachment, NotificationSetting, PendingReply, \
+                    delete_post_fragments, touch_version, defer_vote_counts, defer_post_signals
+from .authors import attach_author_cards
+from . import sanitizer, votebuffer, search, thumbnails
+import datetime, time, logging
 
-@task(ignore_result=True)
-def notification_post_moderation_pending(post_id, mode='approval'):
-    post = Post.objects.get(id=post_id)
+logger = logging.getLogger(__name__)
 
-    perm = Permission.objects.get_by_natural_key(codename='change_post', app_label='comments', model='post')
-    users = User.objects.filter(Q(is_superuser=True) | Q(groups__permissions=perm) | Q(user_permissions=perm)).distinct()
+MODERATION_MESSAGES = {
+    'approval': ('%s - Post approval pending',
+                 'A new comment on %s has just been posted, you can approve it at the following location:\n\n%s'),
+    'flagged': ('%s - Post has been flagged',
+                'A comment on %s has just been flagged, you can review it at the following location:\n\n%s'),
+    'highlighted': ('%s - Post has been highlighted',
+                    'A comment on %s has just been highlighted, you can review it at the following location:\n\n%s'),
+}
 
-    for user in users:
-        notification_post_moderation_pending_user.delay(post.id, user.id, mode)
+def send_messages(messages):
+    # Deliver all messages over one connection and return the failed ones
+    messages = list(messages)
+    failed_messages = []
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception:
+        # Nothing could be sent without a connection, so all messages failed
+        return messages
+    try:
+        for message in messages:
+            try:
+                connection.send_messages([message])
+            except Exception:
+                failed_messages.append(message)
+    finally:
+        connection.close()
+    return failed_messages
 
-@task(ignore_result=True)
-def notification_post_moderation_pending_user(post_id, user_id, mode='approval'):
-    post = Post.objects.get(id=post_id)
-    user = User.objects.get(id=user_id)
+@task(ignore_result=True, default_retry_delay=60, max_retries=5)
+def notification_post_moderation_pending(post_id, mode='approval', user_ids=None):
+    if mode not in MODERATION_MESSAGES:
+        return
+
+    post = Post.objects.select_related('thread').get(id=post_id)
+
+    if user_ids is None:
+        perm = Permission.objects.get_by_natural_key(codename='change_post', app_label='comments', model='post')
+        users = User.objects.filter(Q(is_superuser=True) | Q(groups__permissions=perm) | Q(user_permissions=perm)).distinct()
+    else:
+        users = User.objects.filter(id__in=user_ids)
+    users = users.exclude(email='')
 
     current_site = Site.objects.get_current()
     absolute_url = 'https://%s%s' % (current_site.domain, post.get_absolute_url())
 
-    if mode == 'approval':
-        user.email_user('%s - Post approval pending' % current_site.name,
-                        'A new comment on %s has just been posted, you can approve it at the following location:\n\n' \
-                        '%s' % (current_site.name, absolute_url))
+    subject, message = MODERATION_MESSAGES[mode]
+    messages = {}
+    for user in users:
+        messages[user.id] = EmailMessage(subject % current_site.name,
+                                         message % (current_site.name, absolute_url),
+                                         to=[user.email])
 
-    elif mode == 'flagged':
-        user.email_user('%s - Post has been flagged' % current_site.name,
-                        'A comment on %s has just been flagged, you can review it at the following location:\n\n' \
-                        '%s' % (current_site.name, absolute_url))
+    failed_messages = send_messages(messages.values())
+    if failed_messages:
+        failed_user_ids = [user_id for user_id, message in messages.items() if message in failed_messages]
+        raise notification_post_moderation_pending.retry(kwargs={'post_id': post_id, 'mode': mode,
+                                                                 'user_ids': failed_user_ids})
 
-    elif mode == 'highlighted':
-        user.email_user('%s - Post has been highlighted' % current_site.name,
-                        'A comment on %s has just been highlighted, you can review it at the following location:\n\n' \
-                        '%s' % (current_site.name, absolute_url))
+@task(ignore_result=True)
+def notification_post_moderation_pending_user(post_id, user_id, mode='approval'):
+    notification_post_moderation_pending.delay(post_id, mode, user_ids=[user_id])
 
 @task(ignore_result=True)
 def notification_post_approved(post_id):
@@ -53,19 +92,49 @@ def notification_post_approved(post_id):
                     'Your comment on %s has just been approved, you can view it at the following location:\n\n' \
                     '%s' % (current_site.name, absolute_url))
 
+@task(ignore_result=True)
+def notification_posts_approved(post_ids):
+    posts = Post.objects.filter(id__in=post_ids, is_approved=True).select_related('thread', 'author')
+    posts = list(posts.order_by('id'))
+
+    current_site = Site.objects.get_current()
+    messages = []
+    for post in posts:
+        if not post.author.email:
+            continue
+        absolute_url = 'https://%s%s' % (current_site.domain, post.get_absolute_url())
+        messages.append(EmailMessage('%s - Post approved' % current_site.name,
+                                     'Your comment on %s has just been approved, you can view it at the following location:\n\n' \
+                                     '%s' % (current_site.name, absolute_url),
+                                     to=[post.author.email]))
+    send_messages(messages)
+
+    for post in posts:
+        notification_post_new_reply(post.id)
+
 @task(ignore_result=True)
 def notification_post_new_reply(post_id):
     post = Post.objects.get(id=post_id, is_approved=True)
 
-    author_ids = set()
-    parent_post = post.parent
-    while parent_post:
-        author_ids.add(parent_post.author.id)
-        parent_post = parent_post.parent
+    author_ids = set(post.get_ancestors().values_list('author_id', flat=True))
 
-    for author_id in author_ids:
+    immediate_settings = NotificationSetting.objects.filter(user__in=author_ids, immediate_replies=True)
+    immediate_author_ids = set(immediate_settings.values_list('user_id', flat=True))
+    for author_id in immediate_author_ids:
         notification_post_new_reply_user.delay(post.id, author_id)
 
+    # Everybody else gets the reply with the next digest
+    digest_author_ids = author_ids - immediate_author_ids
+    digest_author_ids -= set(post.pending_replies.values_list('user_id', flat=True))
+    try:
+        with transaction.atomic():
+            PendingReply.objects.bulk_create([PendingReply(user_id=author_id, post=post)
+                                              for author_id in digest_author_ids])
+    except IntegrityError:
+        # Another run for the same post got in between, add what is still missing
+        for author_id in digest_author_ids:
+            PendingReply.objects.get_or_create(user_id=author_id, post=post)
+
 @task(ignore_result=True)
 def notification_post_new_reply_user(post_id, user_id):
     post = Post.objects.get(id=post_id, is_approved=True)
@@ -78,6 +147,44 @@ def notification_post_new_reply_user(post_id, user_id):
                     'A new reply to your comment on %s has just been posted, you can view it at the following location:\n\n' \
                     '%s' % (current_site.name, absolute_url))
 
+@periodic_task(run_every=datetime.timedelta(minutes=getattr(settings, 'COMMENTS_REPLY_DIGEST_MINUTES', 60)),
+               ignore_result=True)
+def notification_reply_digests():
+    pending_replies = PendingReply.objects.select_related('user', 'post__thread').order_by('user', 'post__crdate')
+
+    user_replies = {}
+    for pending_reply in pending_replies:
+        user_replies.setdefault(pending_reply.user, []).append(pending_reply)
+
+    current_site = Site.objects.get_current()
+
+    messages = {}
+    for user, replies in user_replies.items():
+        posts = [reply.post for reply in replies if reply.post.is_approved and not
+                 (reply.post.is_deleted or reply.post.is_spam)]
+        if not posts or not user.email:
+            PendingReply.objects.filter(id__in=[reply.id for reply in replies]).delete()
+            continue
+
+        absolute_urls = ['https://%s%s' % (current_site.domain, post.get_absolute_url()) for post in posts]
+        if len(posts) == 1:
+            message = EmailMessage('%s - New reply to your post' % current_site.name,
+                                   'A new reply to your comment on %s has just been posted, you can view it at the following location:\n\n' \
+                                   '%s' % (current_site.name, absolute_urls[0]),
+                                   to=[user.email])
+        else:
+            message = EmailMessage('%s - New replies to your posts' % current_site.name,
+                                   '%d new replies to your comments on %s have been posted, you can view them at the following locations:\n\n' \
+                                   '%s' % (len(posts), current_site.name, '\n'.join(absolute_urls)),
+                                   to=[user.email])
+        messages[message] = replies
+
+    # Failed digests stay pending and are retried with the next window
+    failed_messages = send_messages(messages.keys())
+    for message, replies in messages.items():
+        if message not in failed_messages:
+            PendingReply.objects.filter(id__in=[reply.id for reply in replies]).delete()
+
 @task(ignore_result=True, default_retry_delay=10, max_retries=5)
 def clean_post_content(post_id):
     try:
@@ -86,21 +193,306 @@ def clean_post_content(post_id):
     except Post.DoesNotExist as e:
         raise clean_post_content.retry(exc=e)
 
+def get_uncleaned_posts():
+    check_posts = Post.objects.exclude(is_deleted=True).exclude(is_spam=True)
+    return check_posts.filter(content_cleaned__isnull=True)
+
+def iter_post_id_chunks(posts, chunk_size=500, start_id=0):
+    post_ids = posts.filter(id__gt=start_id).order_by('id').values_list('id', flat=True)
+    chunk = []
+    for post_id in post_ids.iterator():
+        chunk.append(post_id)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+CLEAN_UPDATE_BATCH_SIZE = 100
+
+def clean_posts(post_ids, map=map):
+    posts = Post.objects.filter(id__in=post_ids).select_related('thread')
+    posts = list(posts.only('id', 'author', 'content', 'tstamp', 'vote_sum', 'upvotes', 'downvotes',
+                              'thread__id', 'thread__category'))
+    if not posts:
+        return 0
+    attach_author_cards(posts)
+
+    contents_cleaned = map(sanitizer.clean_content, [post.content for post in posts])
+    for post, content_cleaned in zip(posts, contents_cleaned):
+        post.content_cleaned = content_cleaned
+        post.preview = sanitizer.make_preview(content_cleaned)
+
+    # Every row adds five parameters, so the statements are kept well below
+    # the parameter limits of the databases
+    for index in range(0, len(posts), CLEAN_UPDATE_BATCH_SIZE):
+        batch = posts[index:index + CLEAN_UPDATE_BATCH_SIZE]
+        content_cleaned = Case(*[When(id=post.id, then=Value(post.content_cleaned)) for post in batch],
+                               output_field=TextField())
+        preview = Case(*[When(id=post.id, then=Value(post.preview)) for post in batch],
+                       output_field=TextField())
+        Post.objects.filter(id__in=[post.id for post in batch]).update(content_cleaned=content_cleaned, preview=preview)
+        search.index_posts(batch)
+
+    for post in posts:
+        delete_post_fragments(post)
+    for category, thread_id in set((post.thread.category, post.thread_id) for post in posts):
+        touch_version(category, thread_id)
+
+    return len(posts)
+
+def get_clean_marker_key(post_id):
+    return 'comments:clean_post_chunk:%d' % post_id
+
+@task(ignore_result=True)
+def clean_post_chunk(post_ids):
+    try:
+        clean_posts(post_ids)
+    finally:
+        cache.delete_many([get_clean_marker_key(post_id) for post_id in post_ids])
+
 @periodic_task(run_every=crontab(minute=12), ignore_result=True)
 def clean_uncleaned_posts():
-    check_posts = Post.objects.exclude(is_deleted=True).exclude(is_spam=True)
-    uncleaned_posts = check_posts.filter(content_cleaned__isnull=True)
-    for post in uncleaned_posts:
-        post.clean_content()
+    # Posts stay marked while their chunk is queued, every other uncleaned post
+    # is dispatched again, including those of failed chunks
+    for post_ids in iter_post_id_chunks(get_uncleaned_posts()):
+        queued_keys = cache.get_many([get_clean_marker_key(post_id) for post_id in post_ids])
+        post_ids = [post_id for post_id in post_ids if get_clean_marker_key(post_id) not in queued_keys]
+        if post_ids:
+            cache.set_many({get_clean_marker_key(post_id): True for post_id in post_ids}, 3600)
+            clean_post_chunk.delay(post_ids)
 
-#@periodic_task(run_every=crontab(minute=42), ignore_result=True)
-def purge_deleted_posts():
-    delete_age = timezone.now() - datetime.timedelta(days=1)
+def update_vote_flags(post, old_vote_sum):
+    was_flagged_post = old_vote_sum <= -3
+    was_highlighted_post = old_vote_sum >= 3
+    is_flagged_post = post.vote_sum <= -3
+    is_highlighted_post = post.vote_sum >= 3
+
+    if is_flagged_post != was_flagged_post or is_highlighted_post != was_highlighted_post:
+        post.is_flagged = is_flagged_post
+        post.is_highlighted = is_highlighted_post
+        post.save(update_fields=('is_flagged', 'is_highlighted'))
+
+        if post.is_flagged and not was_flagged_post:
+            notification_post_moderation_pending.delay(post_id=post.id, mode='flagged')
+        if post.is_highlighted and not was_highlighted_post:
+            notification_post_moderation_pending.delay(post_id=post.id, mode='highlighted')
+
+def flush_votes(entries):
+    # Only the last recorded mode of every vote matters
+    modes = sorted({(post_id, user_id): mode for post_id, user_id, mode in entries}.items())
+    # Every chunk is stored in its own transaction with bounded queries
+    return sum(flush_vote_chunk(dict(modes[index:index + votebuffer.BUFFER_BATCH_SIZE]))
+               for index in range(0, len(modes), votebuffer.BUFFER_BATCH_SIZE))
+
+def flush_vote_chunk(modes):
+    # Users deleted since their vote was recorded are skipped like purged posts
+    user_ids = set(User.objects.filter(id__in=set(user_id for post_id, user_id in modes)).values_list('id', flat=True))
+
+    with transaction.atomic():
+        posts = Post.objects.select_for_update().filter(id__in=set(post_id for post_id, user_id in modes))
+        posts = posts.only('id', 'thread', 'vote_sum', 'upvotes', 'downvotes', 'is_flagged', 'is_highlighted')
+        posts = {post.id: post for post in posts}
+        saved_votes = Vote.objects.filter(post__in=list(posts), user__in=user_ids)
+        saved_votes = {(post_id, user_id): (id, mode) for id, post_id, user_id, mode
+                       in saved_votes.values_list('id', 'post_id', 'user_id', 'mode')}
 
-    delete_posts = Post.objects.filter(is_deleted=True).filter(tstamp__lt=delete_age)
-    if delete_posts.exists():
-        delete_posts.delete()
+        delete_vote_ids = []
+        new_votes = []
+        post_ids = set()
+        for (post_id, user_id), mode in modes.items():
+            vote_id, saved_mode = saved_votes.get((post_id, user_id), (None, 0))
+            if post_id not in posts or user_id not in user_ids or mode == saved_mode:
+                continue
+            if vote_id:
+                delete_vote_ids.append(vote_id)
+            if mode:
+                new_votes.append(Vote(post_id=post_id, user_id=user_id, mode=mode))
+            post_ids.add(post_id)
+        if not post_ids:
+            return 0
 
-    delete_threads = Thread.objects.filter(posts=None).filter(is_deleted=True).filter(tstamp__lt=delete_age)
-    if delete_threads.exists():
-        delete_threads.delete()
+        with defer_vote_counts():
+            Vote.objects.filter(id__in=delete_vote_ids).delete()
+        Vote.objects.bulk_create(new_votes)
+
+        upvotes = Sum(Case(When(mode=1, then=1), default=0, output_field=IntegerField()))
+        downvotes = Sum(Case(When(mode=-1, then=1), default=0, output_field=IntegerField()))
+        vote_counts = Vote.objects.filter(post__in=post_ids).values('post')
+        vote_counts = vote_counts.annotate(vote_sum=Sum('mode'), upvotes=upvotes, downvotes=downvotes).order_by()
+        vote_counts = {vote_count.pop('post'): vote_count for vote_count in vote_counts}
+        for post_id in post_ids:
+            vote_counts.setdefault(post_id, {'vote_sum': 0, 'upvotes': 0, 'downvotes': 0})
+
+        def get_vote_count(name):
+            return Case(*[When(id=post_id, then=Value(vote_count[name])) for post_id, vote_count in vote_counts.items()],
+                        output_field=IntegerField())
+        Post.objects.filter(id__in=post_ids).update(vote_sum=get_vote_count('vote_sum'),
+                                                    upvotes=get_vote_count('upvotes'),
+                                                    downvotes=get_vote_count('downvotes'))
+
+        for post_id in post_ids:
+            post = posts[post_id]
+            old_vote_sum = post.vote_sum
+            post.vote_sum = vote_counts[post_id]['vote_sum']
+            update_vote_flags(post, old_vote_sum)
+
+        for thread_id, category in Thread.objects.filter(posts__in=post_ids).values_list('id', 'category').distinct():
+            touch_version(category, thread_id)
+
+    return len(delete_vote_ids) + len(new_votes)
+
+@periodic_task(run_every=datetime.timedelta(seconds=getattr(settings, 'COMMENTS_VOTE_FLUSH_SECONDS', 30)),
+               ignore_result=True)
+def flush_vote_buffer():
+    # Runs even with the buffer disabled so nothing recorded before is lost
+    if not cache.add('comments:vote_buffer:lock', True, 300):
+        return
+    try:
+        entries, tail, position = votebuffer.read_entries()
+        try:
+            flush_votes(entries)
+        except (IntegrityError, DataError):
+            # Flush the posts one by one, so a bad entry can only hold back its own post.
+            # Any other error leaves the buffer as it is for the next run.
+            post_entries_by_id = {}
+            for entry in entries:
+                post_entries_by_id.setdefault(entry[0], []).append(entry)
+            failed_post_ids = set()
+            for post_id, post_entries in sorted(post_entries_by_id.items()):
+                try:
+                    flush_votes(post_entries)
+                except (IntegrityError, DataError):
+                    logger.exception('Could not flush the buffered votes of post %d', post_id)
+                    votebuffer.quarantine(post_entries)
+                    failed_post_ids.add(post_id)
+            entries = [entry for entry in entries if entry[0] not in failed_post_ids]
+        votebuffer.forget(entries)
+        if position != tail:
+            votebuffer.trim_entries(tail, position)
+    finally:
+        cache.delete('comments:vote_buffer:lock')
+
+@task(ignore_result=True, default_retry_delay=10, max_retries=5)
+def create_media_derivatives(media_id):
+    try:
+        media = Media.objects.select_related('post', 'post__thread').get(id=media_id)
+    except Media.DoesNotExist as e:
+        raise create_media_derivatives.retry(exc=e)
+    old_names = thumbnails.create_derivatives(media)
+    delete_files(media.image.storage, old_names)
+
+    delete_post_fragments(media.post)
+    touch_version(media.post.thread.category, media.post.thread_id)
+
+def get_purge_age():
+    return timezone.now() - datetime.timedelta(days=getattr(settings, 'COMMENTS_PURGE_DAYS', 1))
+
+def get_purge_post_ids(post_ids, delete_age):
+    # Posts are only purged without any surviving replies, together with all
+    # of their replies, so nothing visible is ever removed by the cascade.
+    # The posts of the threads stay locked until the caller's transaction
+    # ends, so none of them can be undeleted or replied to in the meantime.
+    thread_ids = set(Post.objects.filter(id__in=post_ids).values_list('thread_id', flat=True))
+    thread_posts = Post.objects.select_for_update().filter(thread__in=thread_ids)
+    thread_posts = thread_posts.values_list('id', 'path', 'is_deleted', 'tstamp')
+
+    purgeable_paths = {}
+    surviving_paths = set()
+    for post_id, path, is_deleted, tstamp in thread_posts.iterator():
+        if is_deleted and tstamp < delete_age:
+            purgeable_paths[post_id] = path
+        else:
+            surviving_paths.update(path[:end] for end in range(Post.PATH_SEGMENT_LENGTH, len(path) + 1,
+                                                               Post.PATH_SEGMENT_LENGTH))
+
+    root_ids = set(post_id for post_id in post_ids
+                   if post_id in purgeable_paths and not purgeable_paths[post_id] in surviving_paths)
+    root_paths = set(purgeable_paths[post_id] for post_id in root_ids)
+    for post_id, path in purgeable_paths.items():
+        if any(path[:end] in root_paths for end in range(Post.PATH_SEGMENT_LENGTH, len(path) + 1,
+                                                         Post.PATH_SEGMENT_LENGTH)):
+            root_ids.add(post_id)
+    return root_ids
+
+def delete_files(storage, names):
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.exception('Could not delete the purged file %s', name)
+
+def purge_posts(post_ids, delete_age, dry_run=False):
+    # Deletes one chunk of posts in a short transaction and returns what has
+    # been, or with dry_run would have been, deleted
+    report = dict.fromkeys(('posts', 'votes', 'media', 'attachments', 'threads'), 0)
+    with transaction.atomic():
+        post_ids = get_purge_post_ids(post_ids, delete_age)
+        if not post_ids:
+            return report
+
+        thread_ids = set(Post.objects.filter(id__in=post_ids).values_list('thread_id', flat=True))
+        remaining_posts = Post.objects.filter(thread=OuterRef('pk')).exclude(id__in=post_ids)
+        threads = Thread.objects.filter(id__in=thread_ids).annotate(has_posts=Exists(remaining_posts.values('id')))
+        orphaned_thread_ids = set(threads.filter(has_posts=False).values_list('id', flat=True))
+        media_names = list(Media.objects.filter(post__in=post_ids).exclude(image='').values_list('image', flat=True))
+        media_names += MediaDerivative.objects.filter(media__post__in=post_ids).values_list('image', flat=True)
+        attachment_names = list(Attachment.objects.filter(post__in=post_ids).exclude(file='').values_list('file', flat=True))
+
+        report.update(posts=len(post_ids), media=len(media_names), attachments=len(attachment_names),
+                      threads=len(orphaned_thread_ids))
+        if dry_run:
+            report['votes'] = Vote.objects.filter(post__in=post_ids).count()
+            return report
+
+        with defer_vote_counts(), defer_post_signals():
+            deleted, deleted_counts = Post.objects.filter(id__in=post_ids).delete()
+        report['votes'] = deleted_counts.get(Vote._meta.label, 0)
+        search.unindex_posts(post_ids)
+
+        Thread.objects.filter(id__in=orphaned_thread_ids).delete()
+        for thread in Thread.objects.filter(id__in=thread_ids - orphaned_thread_ids):
+            thread.update_summary()
+            touch_version(thread.category, thread.id)
+
+        # Files can not be rolled back, so they are only removed once the rows are gone
+        transaction.on_commit(lambda: delete_files(Media._meta.get_field('image').storage, media_names))
+        transaction.on_commit(lambda: delete_files(Attachment._meta.get_field('file').storage, attachment_names))
+
+    return report
+
+def purge_orphaned_threads(delete_age, chunk_size=500, dry_run=False):
+    # Deleted threads which have lost all of their posts some other way
+    threads = Thread.objects.filter(posts=None, is_deleted=True, tstamp__lt=delete_age)
+    thread_ids = list(threads.order_by('id').values_list('id', flat=True)[:chunk_size])
+    if thread_ids and not dry_run:
+        Thread.objects.filter(id__in=thread_ids).delete()
+    return len(thread_ids)
+
+def iter_purge_reports(delete_age, chunk_size=500, chunk_delay=0, max_chunks=None, dry_run=False):
+    # Every chunk is looked up on its own, no cursor stays open while deleting
+    posts = Post.objects.filter(is_deleted=True, tstamp__lt=delete_age).order_by('id')
+    last_id = 0
+    index = 0
+    while max_chunks is None or index < max_chunks:
+        post_ids = list(posts.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not post_ids:
+            return
+        if index and chunk_delay:
+            # Leave the database some room between the chunks
+            time.sleep(chunk_delay)
+        report = purge_posts(post_ids, delete_age, dry_run)
+        last_id = report['last_id'] = post_ids[-1]
+        index += 1
+        yield report
+
+@periodic_task(run_every=crontab(minute=42), ignore_result=True)
+def purge_deleted_posts():
+    delete_age = get_purge_age()
+    reports = iter_purge_reports(delete_age,
+                                 chunk_size=getattr(settings, 'COMMENTS_PURGE_CHUNK_SIZE', 500),
+                                 chunk_delay=getattr(settings, 'COMMENTS_PURGE_CHUNK_DELAY', 1),
+                                 max_chunks=getattr(settings, 'COMMENTS_PURGE_MAX_CHUNKS', 20))
+    purged_posts = sum(report['posts'] for report in reports)
+    purge_orphaned_threads(delete_age)
+    return purged_posts
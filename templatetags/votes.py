@@ -4,8 +4,11 @@ from ..models import Vote
 
 register = template.Library()
 
-@register.assignment_tag
-def get_vote(post, user):
+@register.assignment_tag(takes_context=True)
+def get_vote(context, post, user):
+    votes = context.get('votes')
+    if votes is not None:
+        return Vote(post=post, user=user, mode=votes.get(post.id))
     try:
         return Vote.objects.get(post=post, user=user)
     except Vote.DoesNotExist:
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from PIL import Image
+from .models import Author, Thread, Post, Media, MediaDerivative
+from . import thumbnails
+import io, shutil, tempfile
+
+def make_image(width, height, mode='RGBA', format='PNG'):
+    output = io.BytesIO()
+    Image.new(mode, (width, height), (200, 100, 50, 255)[:len(mode)]).save(output, format)
+    return output.getvalue()
+
+class ResizeImageTests(TestCase):
+    def test_resize_jpeg(self):
+        content, width, height, format = thumbnails.resize_image(make_image(800, 600), 320, 'jpeg')
+        image = Image.open(io.BytesIO(content))
+        self.assertEqual((width, height, format), (320, 240, 'jpeg'))
+        self.assertEqual(image.size, (320, 240))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.mode, 'RGB')
+
+    def test_resize_webp(self):
+        content, width, height, format = thumbnails.resize_image(make_image(800, 600), 160, 'webp')
+        image = Image.open(io.BytesIO(content))
+        self.assertEqual((width, height, format), (160, 120, 'webp'))
+        self.assertEqual(image.size, (160, 120))
+        self.assertEqual(image.format, 'WEBP')
+
+    def test_keep_aspect_ratio(self):
+        result = thumbnails.resize_image(make_image(1000, 3), 160, 'jpeg')
+        self.assertEqual(result[1:3], (160, 1))
+
+    def test_skip_widths_not_below_original(self):
+        data = make_image(300, 200)
+        self.assertIsNone(thumbnails.resize_image(data, 300, 'jpeg'))
+        self.assertIsNone(thumbnails.resize_image(data, 640, 'jpeg'))
+
+@override_settings(COMMENTS_MEDIA_WIDTHS=(160, 320, 640, 1000), COMMENTS_MEDIA_WEBP=True)
+class CreateDerivativesTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/')
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        # Created without signals, which would queue the celery tasks
+        author = Author.objects.create(username='author')
+        thread = Thread.objects.create()
+        Post.objects.bulk_create([Post(thread=thread, author=author, content='Post', content_cleaned='Post')])
+        name = default_storage.save('comments/posts/image.png', ContentFile(make_image(800, 600)))
+        Media.objects.bulk_create([Media(post=Post.objects.get(), image=name, width=800, height=600)])
+        self.media = Media.objects.get()
+
+    def test_create_derivatives(self):
+        self.assertEqual(thumbnails.create_derivatives(self.media), [])
+        derivatives = MediaDerivative.objects.filter(media=self.media)
+        self.assertEqual(sorted(derivatives.values_list('format', 'width', 'height')),
+                         [('jpeg', 160, 120), ('jpeg', 320, 240), ('jpeg', 640, 480),
+                          ('webp', 160, 120), ('webp', 320, 240), ('webp', 640, 480)])
+        for derivative in derivatives:
+            with default_storage.open(derivative.image.name, 'rb') as image_file:
+                image = Image.open(io.BytesIO(image_file.read()))
+            self.assertEqual(image.size, (derivative.width, derivative.height))
+            self.assertEqual(image.format, derivative.format.upper())
+
+    def test_srcset(self):
+        thumbnails.create_derivatives(self.media)
+        media = Media.objects.prefetch_related('derivatives').get()
+        self.assertEqual(media.thumbnail.width, 160)
+        self.assertEqual(media.srcset, '/media/comments/posts/image_160w.jpeg 160w, '
+                                       '/media/comments/posts/image_320w.jpeg 320w, '
+                                       '/media/comments/posts/image_640w.jpeg 640w')
+        self.assertEqual(media.webp_srcset, '/media/comments/posts/image_160w.webp 160w, '
+                                            '/media/comments/posts/image_320w.webp 320w, '
+                                            '/media/comments/posts/image_640w.webp 640w')
+
+    def test_replace_derivatives(self):
+        thumbnails.create_derivatives(self.media)
+        old_names = set(MediaDerivative.objects.values_list('image', flat=True))
+        self.assertEqual(set(thumbnails.create_derivatives(self.media)), old_names)
+        self.assertEqual(MediaDerivative.objects.filter(media=self.media).count(), 6)
+        self.assertFalse(old_names & set(MediaDerivative.objects.values_list('image', flat=True)))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+import io, os.path
+
+DERIVATIVE_QUALITY = 85
+
+def get_widths():
+    return getattr(settings, 'COMMENTS_MEDIA_WIDTHS', (160, 320, 640))
+
+def get_formats():
+    if getattr(settings, 'COMMENTS_MEDIA_WEBP', False):
+        return ('jpeg', 'webp')
+    return ('jpeg',)
+
+def resize_image(data, width, format):
+    # Works on plain bytes only, so it can run in worker processes
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if width >= image.width:
+        return None
+    height = max(1, round(image.height * width / image.width))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image = image.resize((width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format.upper(), quality=DERIVATIVE_QUALITY)
+    return output.getvalue(), width, height, format
+
+def create_derivatives(media, map=map):
+    from .models import MediaDerivative
+    storage = media.image.storage
+    with storage.open(media.image.name, 'rb') as image_file:
+        data = image_file.read()
+
+    variants = [(width, format) for format in get_formats() for width in get_widths()]
+    results = map(resize_image, [data] * len(variants), *zip(*variants))
+
+    base_name = os.path.splitext(media.image.name)[0]
+    derivatives = []
+    for result in results:
+        if result is None:
+            continue
+        content, width, height, format = result
+        name = storage.save('%s_%dw.%s' % (base_name, width, format), ContentFile(content))
+        derivatives.append(MediaDerivative(media=media, image=name, format=format, width=width, height=height))
+
+    # Returns the names of the replaced files, which are up to the caller to delete
+    with transaction.atomic():
+        old_names = list(media.derivatives.values_list('image', flat=True))
+        media.derivatives.all().delete()
+        MediaDerivative.objects.bulk_create(derivatives)
+    return old_names
@@ -12,6 +12,8 @@ urlpatterns = (
     url(r'^comments/(?P<category>(discussion|request|issue))s/(?P<thread_id>\d+)/(?P<mode>(open|close))/$', views.manage_thread, name='manage_thread'),
     url(r'^comments/(?P<category>(discussion|request|issue))s/(?P<thread_id>\d+)/$', views.show_posts, name='show_posts'),
     url(r'^comments/(?P<category>(discussion|request|issue))s/new/$', views.new_post, name='new_post'),
+    url(r'^comments/search/$', views.search_posts, name='search_posts'),
+    url(r'^comments/moderation/$', views.show_moderation, name='show_moderation'),
     url(r'^comments/(?P<category>(discussion|request|issue))s/(?P<filter>(all|closed))/$', views.show_threads, name='show_threads'),
     url(r'^comments/(?P<category>(discussion|request|issue))s/$', views.show_threads, name='show_threads'),
 )
@@ -1,32 +1,67 @@
 # -*- coding: utf-8 -*-
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.contrib.auth.decorators import login_required, permission_required
 from django.views.decorators.cache import cache_control
 from django.views.decorators.http import condition
-from django.http import HttpResponsePermanentRedirect, HttpResponseRedirect, Http404
+from django.http import HttpResponsePermanentRedirect, HttpResponseRedirect, JsonResponse, Http404
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
 from django.shortcuts import render, get_object_or_404
 from django.utils.translation import ugettext_lazy as _
 from django.forms import inlineformset_factory
 from django.contrib import messages
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef
 from django.utils import timezone
-from .models import Author, Thread, Post, Vote, Media, Attachment
+from .models import Author, Thread, Post, Vote, Media, Attachment, get_version, moderate_posts
+from .pagination import CursorPaginator
+from .authors import attach_author_cards
 from .forms import PostNewForm, PostReplyForm, PostEditForm
-from .tasks import notification_post_moderation_pending, notification_post_approved, notification_post_new_reply
+from .tasks import notification_post_moderation_pending, notification_post_approved, notification_post_new_reply, \
+                   update_vote_flags
+from . import votebuffer, search
 import os.path, datetime
 
-def get_threads(request, category):
-    thread_list = Thread.objects.filter(category=category)
-    if request.user.has_perm('comments.change_post') or request.user.has_perm('comments.delete_post'):
-        yesterday = timezone.now() - datetime.timedelta(days=1)
-        thread_list = thread_list.filter(Q(posts__parent=None), Q(posts__is_deleted=False, posts__is_spam=False) | Q(posts__tstamp__gte=yesterday))
+def is_moderator(user):
+    return user.has_perm('comments.change_post') or user.has_perm('comments.delete_post')
+
+def get_votes(request, posts):
+    if not request.user.is_authenticated():
+        return {}
+    votes = Vote.objects.filter(user=request.user, post__in=posts)
+    votes = dict(votes.values_list('post_id', 'mode'))
+    if votebuffer.is_enabled():
+        # Users see their own votes before they have been flushed
+        votes.update(votebuffer.get_modes(request.user.id, [post.id for post in posts]))
+        votes = {post_id: mode for post_id, mode in votes.items() if mode}
+    return votes
+
+def get_post_list(first_post):
+    post_list = [first_post]
+    for post in post_list:
+        post_list.extend(post.children)
+    return post_list
+
+def get_threads(request, category=None):
+    thread_list = Thread.objects.all()
+    if category:
+        thread_list = thread_list.filter(category=category)
+    first_posts = Post.objects.filter(thread=OuterRef('pk'), parent=None)
+    if is_moderator(request.user):
+        first_posts = first_posts.staff()
     else:
         thread_list = thread_list.exclude(is_deleted=True)
-        thread_list = thread_list.filter(Q(posts__parent=None), Q(posts__is_deleted=False, posts__is_spam=False, posts__is_approved=True))
-    return thread_list.distinct()
+        first_posts = first_posts.active()
+    thread_list = thread_list.annotate(has_first_post=Exists(first_posts.values('id')))
+    return thread_list.filter(has_first_post=True)
+
+def get_posts(request):
+    # Posts of the threads listed by get_threads, with the same visibility rules
+    post_list = Post.objects.filter(thread__in=get_threads(request).values('id'))
+    if is_moderator(request.user):
+        return post_list.staff()
+    return post_list.active()
 
 def show_threads_latest(request, category, filter='open'):
     thread_list = get_threads(request, category)
@@ -39,58 +74,71 @@ def show_threads_latest(request, category, filter='open'):
 def show_threads_etag(request, category, filter='open'):
     if len(messages.get_messages(request)):
         return None
-    try:
-        thread_list = show_threads_latest(request, category, filter)
-        thread_list_posts = Post.objects.filter(thread__in=thread_list)
-        etag = '%d:%d:%d:%d:%d' % (thread_list.count(),
-                                   thread_list.latest('tstamp').id,
-                                   thread_list_posts.count(),
-                                   thread_list_posts.latest('tstamp').id,
-                                   os.path.getmtime(__file__))
-        if request.user.is_authenticated():
-            etag += ':%d' % request.user.id
-        if filter:
-            etag += ':%s' % filter
-        return etag
-    except Thread.DoesNotExist:
-        return None
+    version = get_version(category)
+    etag = '%d:%d' % (version.timestamp() * 1000000,
+                      os.path.getmtime(__file__))
+    if request.user.is_authenticated():
+        etag += ':%d' % request.user.id
+        last_vote = votebuffer.get_last_vote(request.user.id)
+        if last_vote:
+            etag += ':%d' % (last_vote.timestamp() * 1000000)
+    if filter:
+        etag += ':%s' % filter
+    return etag
 
 def show_threads_last_modified(request, category, filter='open'):
     if len(messages.get_messages(request)):
         return None
-    try:
-        thread_list = show_threads_latest(request, category, filter)
-        thread_list_posts = Post.objects.filter(thread__in=thread_list)
-        last_modified = max(thread_list.latest('tstamp').tstamp,
-                            thread_list_posts.latest('tstamp').tstamp,
-                            datetime.datetime.fromtimestamp(os.path.getmtime(__file__),
-                                                            timezone.get_current_timezone()))
-        if request.user.is_authenticated():
-            last_modified = max(last_modified, request.user.last_login)
-        return last_modified
-    except Thread.DoesNotExist:
-        return None
+    last_modified = max(get_version(category),
+                        datetime.datetime.fromtimestamp(os.path.getmtime(__file__),
+                                                        timezone.get_current_timezone()))
+    if request.user.is_authenticated():
+        last_modified = max(last_modified, request.user.last_login,
+                            votebuffer.get_last_vote(request.user.id) or last_modified)
+    return last_modified
 
 @cache_control(private=True, must_revalidate=True)
 @condition(etag_func=show_threads_etag, last_modified_func=show_threads_last_modified)
 def show_threads(request, category, filter='open'):
+    if is_moderator(request.user):
+        first_post_field = 'first_staff_post'
+    else:
+        first_post_field = 'first_active_post'
+
     thread_list = show_threads_latest(request, category, filter)
+    thread_list = thread_list.select_related(first_post_field)
 
-    paginator = Paginator(thread_list, 10)
+    paginator = CursorPaginator(thread_list, 10)
     page = request.GET.get('page')
+    if page is not None:
+        # Translate old page numbers into cursors, e.g. from external links
+        try:
+            cursor = paginator.page_cursor(int(page))
+        except ValueError:
+            cursor = None
+        if cursor:
+            return HttpResponseRedirect('%s?after=%s' % (request.path, cursor))
+        return HttpResponseRedirect(request.path)
+
     try:
-        threads = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        threads = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        threads = paginator.page(paginator.num_pages)
+        threads = paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
+    except ValueError:
+        # If the cursor is invalid, deliver first page.
+        threads = paginator.page()
+
+    first_posts = []
+    for thread in threads:
+        first_post = getattr(thread, first_post_field)
+        if first_post:
+            first_post.thread = thread
+            first_posts.append(first_post)
+    attach_author_cards(first_posts)
 
     template_values = {
         'category': category,
         'threads': threads,
         'filter': filter,
+        'votes': get_votes(request, first_posts),
     }
 
     return render(request, 'show_threads.html', template_values)
@@ -102,33 +150,27 @@ def show_posts_latest(request, category, thread_id):
 def show_posts_etag(request, category, thread_id):
     if len(messages.get_messages(request)):
         return None
-    try:
-        thread = show_posts_latest(request, category, thread_id)
-        thread_latest_post = thread.posts.latest('tstamp')
-        etag = '%d:%d:%d:%d:%d' % (thread.posts.count(),
-                                   thread.id,
-                                   thread_latest_post.id,
-                                   thread_latest_post.vote_sum or 0,
-                                   os.path.getmtime(__file__))
-        if request.user.is_authenticated():
-            etag += ':%d' % request.user.id
-        return etag
-    except Http404:
-        return None
+    version = get_version(category, int(thread_id))
+    etag = '%d:%d:%d' % (int(thread_id),
+                         version.timestamp() * 1000000,
+                         os.path.getmtime(__file__))
+    if request.user.is_authenticated():
+        etag += ':%d' % request.user.id
+        last_vote = votebuffer.get_last_vote(request.user.id)
+        if last_vote:
+            etag += ':%d' % (last_vote.timestamp() * 1000000)
+    return etag
 
 def show_posts_last_modified(request, category, thread_id):
     if len(messages.get_messages(request)):
         return None
-    try:
-        thread = show_posts_latest(request, category, thread_id)
-        last_modified = max(thread.posts.latest('tstamp').tstamp,
-                            datetime.datetime.fromtimestamp(os.path.getmtime(__file__),
-                                                            timezone.get_current_timezone()))
-        if request.user.is_authenticated():
-            last_modified = max(last_modified, request.user.last_login)
-        return last_modified
-    except Http404:
-        return None
+    last_modified = max(get_version(category, int(thread_id)),
+                        datetime.datetime.fromtimestamp(os.path.getmtime(__file__),
+                                                        timezone.get_current_timezone()))
+    if request.user.is_authenticated():
+        last_modified = max(last_modified, request.user.last_login,
+                            votebuffer.get_last_vote(request.user.id) or last_modified)
+    return last_modified
 
 @cache_control(private=True, must_revalidate=True)
 @condition(etag_func=show_posts_etag, last_modified_func=show_posts_last_modified)
@@ -143,10 +185,7 @@ def show_posts(request, category, thread_id):
             raise e
 
     try:
-        if request.user.has_perm('comments.change_post') or request.user.has_perm('comments.delete_post'):
-            first_post = thread.first_staff_post
-        else:
-            first_post = thread.first_active_post
+        first_post = thread.get_post_tree(staff=is_moderator(request.user))
     except Post.DoesNotExist:
         raise Http404
 
@@ -154,11 +193,37 @@ def show_posts(request, category, thread_id):
         'category': category,
         'thread': thread,
         'first_post': first_post,
+        'votes': get_votes(request, get_post_list(first_post)),
     }
 
     return render(request, 'show_posts.html', template_values)
 
 
+def search_posts(request):
+    query = request.GET.get('q', '').strip()
+
+    post_list = Post.objects.none()
+    if query:
+        post_list = search.search_posts(get_posts(request).select_related('thread'), query)
+
+    paginator = Paginator(post_list, 20)
+    try:
+        posts = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        posts = paginator.page(1)
+    except EmptyPage:
+        posts = paginator.page(paginator.num_pages)
+    posts.object_list = list(posts.object_list)
+    attach_author_cards(posts.object_list)
+
+    template_values = {
+        'query': query,
+        'posts': posts,
+    }
+
+    return render(request, 'search_posts.html', template_values)
+
+
 @login_required
 @transaction.atomic
 def new_post(request, category):
@@ -327,35 +392,68 @@ def edit_post(request, category, thread_id, post_id):
     return render(request, 'edit_post.html', template_values)
 
 
-@login_required
-def vote_post(request, category, thread_id, post_id, mode):
-    thread = get_object_or_404(Thread, category=category, id=thread_id)
-    post = get_object_or_404(Post, thread=thread, id=post_id)
-
-    modes = {'up': 1, 'down': -1}
+def adjust_vote_counts(post, old_mode, new_mode):
+    for mode, sign in ((old_mode, -1), (new_mode, 1)):
+        if mode:
+            for name, count in Vote(mode=mode).vote_counts.items():
+                setattr(post, name, getattr(post, name) + sign * count)
+            post.vote_sum += sign * mode
 
-    try:
-        vote = Vote.objects.get(user=request.user, post=post)
+def toggle_vote(user, post, mode):
+    # The post row is locked by the caller, so concurrent clicks of the same
+    # user are serialized here instead of racing on unique_together
+    vote = Vote.objects.filter(user=user, post=post).first()
+    if vote:
         vote.delete()
-        messages.info(request, _('<strong>Thanks</strong>, your vote has successfully been removed.'))
-    except Vote.DoesNotExist:
-        vote = Vote(user=request.user, post=post, mode=modes[mode])
-        vote.save()
-        messages.success(request, _('<strong>Thanks</strong>, your vote has successfully been recorded.'))
+        adjust_vote_counts(post, vote.mode, 0)
+        return 0
+    Vote.objects.create(user=user, post=post, mode=mode)
+    adjust_vote_counts(post, 0, mode)
+    return mode
+
+def toggle_buffered_vote(user, post, mode):
+    # The vote is only recorded in the buffer and written by flush_vote_buffer,
+    # the counters of the post are adjusted for the response only
+    saved_mode = Vote.objects.filter(user=user, post=post).values_list('mode', flat=True).first() or 0
+    old_mode = votebuffer.get_modes(user.id, [post.id]).get(post.id, saved_mode)
+    new_mode = 0 if old_mode else mode
+    votebuffer.record(post.id, user.id, new_mode)
+    adjust_vote_counts(post, saved_mode, new_mode)
+    return new_mode
 
-    vote_sum = post.vote_sum
-    if vote_sum:
-        was_flagged_post = post.is_flagged
-        was_highlighted_post = post.is_highlighted
 
-        post.is_flagged = vote_sum <= -3
-        post.is_highlighted = vote_sum >= 3
-        post.save(update_fields=('is_flagged', 'is_highlighted'))
+@login_required
+def vote_post(request, category, thread_id, post_id, mode):
+    modes = {'up': 1, 'down': -1}
 
-        if post.is_flagged and not was_flagged_post:
-            notification_post_moderation_pending.delay(post_id=post.id, mode='flagged')
-        if post.is_highlighted and not was_highlighted_post:
-            notification_post_moderation_pending.delay(post_id=post.id, mode='highlighted')
+    if votebuffer.is_enabled():
+        posts = Post.objects.select_related('thread')
+        post = get_object_or_404(posts, thread__category=category, thread_id=thread_id, id=post_id)
+        vote_mode = toggle_buffered_vote(request.user, post, modes[mode])
+    else:
+        with transaction.atomic():
+            # Only the post row is locked, joining the thread here would lock it as well
+            post = get_object_or_404(Post.objects.select_for_update(), thread_id=thread_id, id=post_id)
+            if post.thread.category != category:
+                raise Http404
+            old_vote_sum = post.vote_sum
+            vote_mode = toggle_vote(request.user, post, modes[mode])
+            update_vote_flags(post, old_vote_sum)
+
+    if request.is_ajax():
+        vote_modes = {1: 'up', -1: 'down'}
+        return JsonResponse({
+            'post': post.id,
+            'score': post.vote_sum,
+            'upvotes': post.upvotes,
+            'downvotes': post.downvotes,
+            'vote': vote_modes.get(vote_mode),
+        })
+
+    if vote_mode:
+        messages.success(request, _('<strong>Thanks</strong>, your vote has successfully been recorded.'))
+    else:
+        messages.info(request, _('<strong>Thanks</strong>, your vote has successfully been removed.'))
 
     return HttpResponseRedirect(post.get_absolute_url())
 
@@ -377,6 +475,62 @@ def manage_thread(request, category, thread_id, mode):
     return HttpResponseRedirect(thread.get_absolute_url())
 
 
+def get_moderation_queue():
+    # Pending, flagged and highlighted posts, each of them covered by an index
+    post_list = Post.objects.filter(Q(is_approved=False) | Q(is_flagged=True) | Q(is_highlighted=True))
+    return post_list.exclude(is_deleted=True).exclude(is_spam=True)
+
+@permission_required('comments.change_post')
+def show_moderation(request):
+    decisions = {
+        'approve': ('approve',),
+        'spam': ('spam',),
+        'delete': ('delete',),
+        'dismiss': ('unflag', 'unhighlight'),
+    }
+
+    if request.method == 'POST':
+        post_ids = {}
+        for name, decision in request.POST.items():
+            if name.startswith('decision-') and decision in decisions and name[9:].isdigit():
+                post_ids.setdefault(decision, []).append(int(name[9:]))
+        if 'delete' in post_ids and not request.user.has_perm('comments.delete_post'):
+            raise PermissionDenied
+
+        # All decisions are applied at once, approvals are notified in one task
+        count = 0
+        with transaction.atomic():
+            for decision, decision_post_ids in post_ids.items():
+                posts = get_moderation_queue().filter(id__in=decision_post_ids)
+                changed_post_ids = set()
+                for action in decisions[decision]:
+                    changed_post_ids.update(moderate_posts(posts, action))
+                count += len(changed_post_ids)
+
+        if count:
+            messages.success(request, _('<strong>Great</strong>, %d posts have successfully been moderated.') % count)
+        return HttpResponseRedirect(request.get_full_path())
+
+    post_list = get_moderation_queue().select_related('thread').defer('content', 'content_cleaned', 'path')
+    try:
+        after = int(request.GET['after'])
+        post_list = post_list.filter(id__lt=after)
+    except (KeyError, ValueError):
+        after = None
+
+    posts = list(post_list.order_by('-id')[:51])
+    next_cursor = posts[49].id if len(posts) > 50 else None
+    posts = posts[:50]
+    attach_author_cards(posts)
+
+    template_values = {
+        'posts': posts,
+        'after': after,
+        'next_cursor': next_cursor,
+    }
+
+    return render(request, 'show_moderation.html', template_values)
+
 @permission_required('comments.change_post')
 def approve_post(request, category, thread_id, post_id):
     thread = get_object_or_404(Thread, category=category, id=thread_id)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+BUFFER_TIMEOUT = 86400
+BUFFER_BATCH_SIZE = 1000
+
+HEAD_KEY = 'comments:vote_buffer:head'
+TAIL_KEY = 'comments:vote_buffer:tail'
+GAP_KEY = 'comments:vote_buffer:gap'
+FAILED_KEY = 'comments:vote_buffer:failed'
+
+def is_enabled():
+    return getattr(settings, 'COMMENTS_VOTE_BUFFER', False)
+
+def get_mode_key(post_id, user_id):
+    return 'comments:vote_buffer:mode:%d:%d' % (post_id, user_id)
+
+def get_last_vote_key(user_id):
+    return 'comments:vote_buffer:last_vote:%d' % user_id
+
+def get_entry_key(position):
+    return 'comments:vote_buffer:entry:%d' % position
+
+def get_modes(user_id, post_ids):
+    # The votes of the user which have not been flushed yet, 0 for removed votes
+    keys = {get_mode_key(post_id, user_id): post_id for post_id in post_ids}
+    return {keys[key]: mode for key, mode in cache.get_many(list(keys)).items()}
+
+def get_last_vote(user_id):
+    # Pages of the user are cached at most until their last buffered vote
+    if not is_enabled():
+        return None
+    return cache.get(get_last_vote_key(user_id))
+
+def record(post_id, user_id, mode):
+    cache.set(get_mode_key(post_id, user_id), mode, BUFFER_TIMEOUT)
+    cache.set(get_last_vote_key(user_id), timezone.now(), BUFFER_TIMEOUT)
+    cache.add(HEAD_KEY, 0, None)
+    position = cache.incr(HEAD_KEY)
+    cache.set(get_entry_key(position), (post_id, user_id, mode), BUFFER_TIMEOUT)
+
+def read_entries(max_entries=10000):
+    # Returns the buffered (post_id, user_id, mode) entries in the order they
+    # were recorded, together with the range of positions they were read from
+    head = cache.get(HEAD_KEY, 0)
+    tail = cache.get(TAIL_KEY, 0)
+    if head < tail:
+        # The counter got evicted and started over
+        tail = 0
+    head = min(head, tail + max_entries)
+
+    entries = []
+    position = tail
+    while position < head:
+        keys = [get_entry_key(index) for index in range(position + 1, min(position + BUFFER_BATCH_SIZE, head) + 1)]
+        values = cache.get_many(keys)
+        for key in keys:
+            if key in values:
+                entries.append(values[key])
+            elif cache.get(GAP_KEY) != position + 1:
+                # The entry may still be on its way, look again with the next flush
+                cache.set(GAP_KEY, position + 1, BUFFER_TIMEOUT)
+                return entries, tail, position
+            position += 1
+    return entries, tail, position
+
+def trim_entries(tail, position):
+    cache.delete_many([get_entry_key(index) for index in range(tail + 1, position + 1)])
+    cache.set(TAIL_KEY, position, None)
+
+def forget(entries):
+    # Flushed votes are read from the database again, unless the user has voted
+    # anew in the meantime
+    modes = {get_mode_key(post_id, user_id): mode for post_id, user_id, mode in entries}
+    cache.delete_many([key for key, mode in cache.get_many(list(modes)).items() if modes[key] == mode])
+
+def quarantine(entries):
+    # Entries which could not be flushed are set aside for a look by hand, the
+    # users see their stored votes again
+    cache.delete_many([get_mode_key(post_id, user_id) for post_id, user_id, mode in entries])
+    failed_entries = cache.get(FAILED_KEY, []) + list(entries)
+    cache.set(FAILED_KEY, failed_entries[-BUFFER_BATCH_SIZE:], BUFFER_TIMEOUT)